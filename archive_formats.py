@@ -0,0 +1,255 @@
+import struct
+
+# Types of numpy columns for the struct format characters, for numpy_dtype.
+NUMPY_TYPES = {"B": "u1", "H": "u2", "I": "u4", "Q": "u8", "b": "i1", "h": "i2", "i": "i4", "q": "i8"}
+
+# How much of a view without a find method extract_strz searches at a time.
+STRZ_SEARCH_BLOCK_SIZE = 256
+
+def extract_strz(content, offset):
+    """Returns the null-terminated string starting at offset in content,
+     which may be a string, mmap or view. Raises a ValueError if it is not
+     terminated.
+    """
+
+    if hasattr(content, "find"):
+        end = content.find('\x00', offset)
+    else:
+        # Views cannot be searched directly, so search a block at a time
+        #  rather than copying all of content.
+        end = -1
+        block_offset = offset
+        while block_offset < len(content):
+            block = content[block_offset:block_offset + STRZ_SEARCH_BLOCK_SIZE]
+            if isinstance(block, memoryview):
+                block = block.tobytes()
+            block_end = block.find('\x00')
+            if block_end >= 0:
+                end = block_offset + block_end
+                break
+            block_offset += len(block)
+    if end < 0:
+        raise ValueError("File has unterminated string at offset " + hex(offset) + ".")
+
+    extracted = content[offset:end]
+    if isinstance(extracted, memoryview):
+        extracted = extracted.tobytes()
+    return extracted
+
+def get_view(content, offset, length):
+    """Returns a read-only view of length bytes of content starting at
+     offset, without copying them where the platform allows it.
+    """
+
+    try:
+        # Python 2 mmaps and zlib only support the old buffer interface.
+        return buffer(content, offset, length)
+    except (NameError, TypeError):
+        # There is no buffer (Python 3), or content is a memoryview.
+        return memoryview(content)[offset:offset + length]
+
+class Layout(object):
+    """A fixed-size structure in an archive file, declared as a list of
+     fields and compiled once into a struct.Struct.
+
+    byte_order is a struct byte order character, such as "<". Each field
+     is a tuple (name, format) or (name, format, value), where format is a
+     struct format of a single value, such as "I" or "4s", or padding, such
+     as "8x". Fields that are given a value are fixed by the format, and
+     are checked when unpacked, but left out of the result. The fixed
+     strings that the structure begins with are its magic bytes.
+    """
+
+    def __init__(self, name, byte_order, fields):
+        self.name = name
+        self.byte_order = byte_order
+        self.format = "".join(field[1] for field in fields)
+        self.struct = struct.Struct(byte_order + self.format)
+        self.size = self.struct.size
+        self.fields = [field for field in fields if not field[1].endswith("x")]
+
+        self._checks = [(i, field[0], field[2]) for (i, field) in enumerate(self.fields) if len(field) > 2]
+        self._value_indices = [i for (i, field) in enumerate(self.fields) if len(field) < 3]
+        self.magic = ""
+        for field in fields:
+            if len(field) < 3 or not field[1].endswith("s"):
+                break
+            self.magic += field[2]
+
+    def has_magic(self, content, offset=0):
+        """Checks if content (a string, or an mmap or view) holds the magic
+         bytes of this structure at offset.
+        """
+
+        found = content[offset:offset + len(self.magic)]
+        if isinstance(found, memoryview):
+            found = found.tobytes()
+        return found == self.magic
+
+    def unpack_from(self, content, offset=0):
+        """Unpacks this structure from content at offset. Returns a tuple of
+         the values of the fields not fixed by the format. Raises a
+         ValueError if content is too short, or a fixed field does not hold
+         its value.
+        """
+
+        self._check_size(content, offset, self.size)
+        values = self.struct.unpack_from(content, offset)
+        for (i, field_name, expected) in self._checks:
+            if values[i] != expected:
+                self._raise_mismatch(field_name, expected, values[i], offset)
+        if len(self._checks) == 0:
+            return values
+        return tuple(values[i] for i in self._value_indices)
+
+    def unpack_array(self, content, offset, count):
+        """Unpacks count of this structure, laid out one after another from
+         offset in content, with a single struct call. Returns a list of
+         tuples as from unpack_from.
+
+        Unlike the struct of a single structure, the struct for count of
+         them is built on each call.
+        """
+
+        return zip(*self.unpack_columns(content, offset, count))
+
+    def unpack_columns(self, content, offset, count):
+        """Unpacks count of this structure as in unpack_array, but returns a
+         list holding a tuple of the values of each field not fixed by the
+         format.
+        """
+
+        if count == 0:
+            return [()] * len(self._value_indices)
+        array_struct = struct.Struct(self.byte_order + self.format * count)
+        self._check_size(content, offset, array_struct.size)
+        values = array_struct.unpack_from(content, offset)
+        columns = [values[i::len(self.fields)] for i in xrange(len(self.fields))]
+        for (i, field_name, expected) in self._checks:
+            if columns[i].count(expected) != count:
+                index = next(j for (j, value) in enumerate(columns[i]) if value != expected)
+                self._raise_mismatch(field_name, expected, columns[i][index], offset + index * self.size)
+        return [columns[i] for i in self._value_indices]
+
+    def numpy_dtype(self):
+        """Returns a numpy structured dtype with a column for each field,
+         fixed or not.
+        """
+
+        return [(field[0], self.byte_order + NUMPY_TYPES[field[1]]) for field in self.fields]
+
+    def _check_size(self, content, offset, size):
+        if len(content) - offset < size:
+            raise ValueError(self.name + " at offset " + hex(offset) + " is truncated.")
+
+    def _raise_mismatch(self, field_name, expected, found, offset):
+        if isinstance(expected, str):
+            (expected, found) = ("'" + expected.encode("hex") + "'", "'" + found.encode("hex") + "'")
+        else:
+            (expected, found) = (hex(expected), hex(found))
+        raise ValueError("Expected " + field_name + " " + expected + " in " + self.name + " at offset " +
+         hex(offset) + ", but received " + found + ".")
+
+# A .dcx file: a header, and then raw deflate data.
+DCX_HEADER = Layout("DCX header", ">", [
+    ("magic", "4s", "DCX\x00"),
+    ("version", "I", 0x10000),
+    ("dcs_offset", "I", 0x18),
+    ("dcp_offset", "I", 0x24),
+    ("unknown", "I", 0x24),
+    ("header_length", "I"),
+    ("dcs_magic", "4s", "DCS\x00"),
+    ("uncompressed_size", "I"),
+    ("compressed_size", "I"),
+    ("dcp_magic", "4s", "DCP\x00"),
+    ("method", "4s", "DFLT"),
+    ("unknown_parameters", "24x"),
+    ("dca_magic", "4s", "DCA\x00"),
+    ("dca_length", "I"),
+    # The zlib header, which the compressed size includes.
+    ("zlib_method", "B", 0x78),
+    ("zlib_flags", "B"),
+])
+
+# A .bhd5 header: the preamble, then a table of hash bins, each listing
+#  the records whose name hashes fall into it.
+BHD5_HEADER = Layout("BHD5 header", "<", [
+    ("magic", "4s", "BHD5"),
+    ("byte_order", "I", 0xff),
+    ("version", "I", 1),
+    ("file_size", "I"),
+    ("bin_count", "I"),
+    ("bin_offset", "I"),
+])
+BHD5_BIN = Layout("BHD5 bin", "<", [
+    ("record_count", "I"),
+    ("record_offset", "I"),
+])
+BHD5_RECORD = Layout("BHD5 record", "<", [
+    ("hash", "I"),
+    ("size", "I"),
+    ("offset", "I"),
+    ("zero", "I", 0),
+])
+
+# The data file of a BDT/BHD pair, of either header format.
+BDF3_HEADER = Layout("BDF3 header", "<", [
+    ("magic", "4s", "BDF3"),
+    ("version", "8s", "07D7R6\x00\x00"),
+    ("unknown", "I", 0),
+])
+
+# BND3 files and *bhd headers share a table of records, whose layout
+#  depends on the flag in the header, and which starts after the header.
+BND3_HEADER = Layout("BND3 header", "<", [
+    ("magic", "4s", "BND3"),
+    ("version", "8s"),
+    ("flag", "I"),
+    ("num_of_records", "I"),
+    ("filename_end_offset", "I"),
+    ("padding", "8x"),
+])
+BHF3_HEADER = Layout("BHF3 header", "<", [
+    ("magic", "4s", "BHF3"),
+    ("version", "8s", "07D7R6\x00\x00"),
+    ("flag", "I"),
+    ("num_of_records", "I"),
+    ("padding", "12x"),
+])
+BINDER3_RECORD = Layout("BND3 record", "<", [
+    ("separator", "I", 0x40),
+    ("filedata_size", "I"),
+    ("filedata_offset", "I"),
+    ("file_id", "I"),
+    ("filename_offset", "I"),
+    ("dummy_filedata_size", "I"),
+])
+BINDER3_SHORT_RECORD = Layout("BND3 record", "<", [
+    ("separator", "I", 0x40),
+    ("filedata_size", "I"),
+    ("filedata_offset", "I"),
+    ("file_id", "I"),
+    ("filename_offset", "I"),
+])
+BINDER3_RECORDS = {0x74: BINDER3_RECORD, 0x54: BINDER3_RECORD, 0x70: BINDER3_SHORT_RECORD}
+
+def unpack_binder_records(content, offset, flag, num_of_records, format_name):
+    """Unpacks the table of num_of_records records at offset in content,
+     from a BND3 or BHF3 (format_name) file with the given flag.
+
+    Returns a list of tuples (file_id, filename_offset, filedata_offset,
+     filedata_size). Raises a ValueError if the flag is unknown, or the
+     records are malformed.
+    """
+
+    if flag not in BINDER3_RECORDS:
+        raise ValueError("File has unknown " + format_name + " magic flag: " + hex(flag))
+    columns = BINDER3_RECORDS[flag].unpack_columns(content, offset, num_of_records)
+    (filedata_sizes, filedata_offsets, file_ids, filename_offsets) = columns[:4]
+    if len(columns) > 4 and columns[4] != filedata_sizes:
+        (filedata_size, dummy_filedata_size) = next((size, dummy_size) for (size, dummy_size)
+         in zip(filedata_sizes, columns[4]) if size != dummy_size)
+        raise ValueError("File has malformed record structure. File data size " +
+         str(filedata_size) + " does not match dummy file data size " +
+         str(dummy_filedata_size) + ".")
+    return zip(file_ids, filename_offsets, filedata_offsets, filedata_sizes)
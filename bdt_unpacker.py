@@ -1,56 +1,20 @@
+import logging
+log = logging.getLogger(__name__)
+
 import mmap
-import os
 import sys
-import struct
+import time
 
-import name_hash_handler
+import archive_formats
 import dcx_uncompresser
+import memory_budget
+import output_files
 
-def consume_byte(content, offset, byte, length=1):
-    """Consume length bytes from content, starting at offset. If they
-     are not all byte, raises a ValueError.
-    """
-    
-    for i in xrange(0, length-1):
-        if content[offset + i] != byte:
-            raise ValueError("Expected byte '" + byte.encode("hex") + "' at offset " +\
-                    hex(offset + i) + " but received byte '" +\
-                    content[offset + i].encode("hex") + "'.")
-    return offset + length
-    
-def extract_strz(content, offset):
-    extracted = ''
-    while content[offset] != '\x00':
-        extracted = extracted + content[offset]
-        offset += 1
-    return extracted
-
-def fix_filename(base, filepath):
-    """Joins filepath to base, and converts to the system's path separator."""
-    
-    # Append ./ to filepath so that it is correctly joined with base.
-    #  If filepath begins with /, this prevents base from being ignored.
-    return os.path.normpath(os.path.join(base, "./" + filepath))
-
-def create_file(filename):
-    """Attempts to create filename."""
-    
-    path = os.path.dirname(filename)
-    
-    try:
-        os.makedirs(path)
-    except OSError:
-        if not os.path.isdir(path):
-            raise
-    
-    f = open(filename, "wb+")
-    return f
-    
 def appears_bhd(header):
     """ Determines if the given file has the magic bytes of a *bhd header.
     """
     with open(header, 'rb') as h:
-        return h.read(12) == "BHF307D7R6\x00\x00"
+        return archive_formats.BHF3_HEADER.has_magic(h.read(len(archive_formats.BHF3_HEADER.magic)))
 
 def parse_bhd_header_to_dict(header):
     """Parses a *bhd Dark Souls archive header file into a dictionary
@@ -63,45 +27,19 @@ def parse_bhd_header_to_dict(header):
     
     with open(header, 'rb') as h:
         content = h.read()
+    return parse_bhd_content_to_dict(content)
+    
+def parse_bhd_content_to_dict(content):
+    """Parses the content of a *bhd Dark Souls archive header file into a
+     dictionary, as in parse_bhd_header_to_dict.
+    """
+    
     return_dict = {}
     
-    master_offset = 0
-    master_offset = consume_byte(content, master_offset, 'B', 1)
-    master_offset = consume_byte(content, master_offset, 'H', 1)
-    master_offset = consume_byte(content, master_offset, 'F', 1)
-    master_offset = consume_byte(content, master_offset, '3', 1)
-    master_offset = consume_byte(content, master_offset, '0', 1)
-    master_offset = consume_byte(content, master_offset, '7', 1)
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, '7', 1)
-    master_offset = consume_byte(content, master_offset, 'R', 1)
-    master_offset = consume_byte(content, master_offset, '6', 1)
-    master_offset = consume_byte(content, master_offset, '\x00', 1)
-    master_offset = consume_byte(content, master_offset, '\x00', 1)
-    
-    # Skip the version number.
-    master_offset = 0x0c
-    (magic_flag, num_of_records) = struct.unpack_from("<II", content, offset=master_offset)
-    master_offset += struct.calcsize("<II")
-    if not (magic_flag != 0x74 or magic_flag != 0x54):
-        raise ValueError("File has unknown BHD3 magic flag: " + hex(magic_flag))
-    
-    # Skip to the records.
-    master_offset = 0x20
-    
-    for _ in xrange(num_of_records):
-        (record_sep, filedata_size, filedata_offset, file_id, 
-         filename_offset, dummy_filedata_size) = struct.unpack_from("<IIIIII", content, offset=master_offset)
-        master_offset += struct.calcsize("<IIIIII")
-        if filedata_size != dummy_filedata_size:
-            raise ValueError("File has malformed record structure. File data size " + 
-             str(filedata_size) + " does not match dummy file data size " + 
-             str(dummy_filedata_size) + ".")
-        if record_sep != 0x40:
-            raise ValueError("File has malformed record structure. Record" + 
-            " has unknown record separator " + hex(record_sep))
-            
-        filename = extract_strz(content, filename_offset).replace('\\', '/')
+    (magic_flag, num_of_records) = archive_formats.BHF3_HEADER.unpack_from(content)
+    for (_, filename_offset, filedata_offset, filedata_size) in archive_formats.unpack_binder_records(content, 
+     archive_formats.BHF3_HEADER.size, magic_flag, num_of_records, "BHF3"):
+        filename = archive_formats.extract_strz(content, filename_offset).replace('\\', '/')
         return_dict[filename] = (filedata_offset, filedata_size)
     return return_dict
     
@@ -109,99 +47,508 @@ def appears_bhd5(header):
     """ Determines if the given file has the magic byte of a .bhd5 header.
     """
     with open(header, 'rb') as h:
-        return h.read(4) == "BHD5"
+        return archive_formats.BHD5_HEADER.has_magic(h.read(len(archive_formats.BHD5_HEADER.magic)))
+
+# Layouts of the .bhd5 bin and record tables, as numpy structured dtypes.
+BHD5_BIN_DTYPE = archive_formats.BHD5_BIN.numpy_dtype()
+BHD5_RECORD_DTYPE = archive_formats.BHD5_RECORD.numpy_dtype()
+BHD5_RECORD_SIZE = archive_formats.BHD5_RECORD.size
+
+# Records whose hash is not in the name hash dictionary can be unpacked
+#  here instead, named by their hash.
+UNKNOWN_RECORD_DIR = "_unknown"
+
+def get_unknown_record_name(record_hash):
+    """Returns the filepath used for a .bhd5 record whose name is unknown."""
+    
+    return "/" + UNKNOWN_RECORD_DIR + "/" + ("%08x" % record_hash)
+
+# Length of the fixed part of a .bhd5 header, before the bin table.
+BHD5_PREAMBLE_SIZE = archive_formats.BHD5_HEADER.size
+
+def parse_bhd5_preamble(header_str):
+    """Checks the magic bytes of a .bhd5 header and reads its bin count.
+    
+    header_str needs only to contain the first BHD5_PREAMBLE_SIZE bytes of
+     the header. Returns a tuple (bin_count, bin_table_offset).
+    """
+    
+    (file_size, bin_count, bin_offset) = archive_formats.BHD5_HEADER.unpack_from(header_str)
+    return (bin_count, bin_offset)
+
+def lookup_bhd5_record(header, name):
+    """Finds the filepath name in a .bhd5 Dark Souls archive header file,
+     reading only the hash bin that it belongs to.
+     
+    Returns a tuple (offset, length) that determines the binary data of
+     that file inside the associated .bdt file. Raises a KeyError if the
+     header has no record for name.
+    """
+    
+    import name_hash_handler
+    name_hash = name_hash_handler.get_hash_from_string(name)
+    
+    with open(header, 'rb') as h:
+        (bin_count, bin_table_offset) = parse_bhd5_preamble(h.read(BHD5_PREAMBLE_SIZE))
+        if bin_count == 0:
+            raise KeyError(name)
+        
+        h.seek(bin_table_offset + archive_formats.BHD5_BIN.size * (name_hash % bin_count))
+        (bin_record_count, bin_record_offset) = archive_formats.BHD5_BIN.unpack_from(h.read(archive_formats.BHD5_BIN.size))
+        h.seek(bin_record_offset)
+        bin_str = h.read(bin_record_count * BHD5_RECORD_SIZE)
+    
+    for (record_hash, record_size, record_offset) in archive_formats.BHD5_RECORD.unpack_array(bin_str, 0, 
+     bin_record_count):
+        if record_hash == name_hash:
+            return (record_offset, record_size)
+    raise KeyError(name)
+
+def parse_bhd5_header_to_table(header):
+    """Parses a .bhd5 Dark Souls archive header file into a table of
+     the records it contains, decoding the bin and record arrays in bulk.
+     
+    Returns a numpy structured array with the columns hash, size and
+     offset, with one row per record in bin order.
+    """
+    
+    with open(header, 'rb') as h:
+        header_str = h.read()
+    return parse_bhd5_content_to_table(header_str)
+    
+def parse_bhd5_content_to_table(header_str):
+    """Parses the content of a .bhd5 Dark Souls archive header file into a
+     table, as in parse_bhd5_header_to_table.
+    """
+    
+    import numpy as np
+    
+    (bin_count, master_offset) = parse_bhd5_preamble(header_str)
+    bins = np.frombuffer(header_str, dtype=BHD5_BIN_DTYPE, count=bin_count, offset=master_offset)
+    counts = bins["record_count"].astype(np.int64)
+    offsets = bins["record_offset"].astype(np.int64)
+    
+    # Bins normally store their records back to back, so that the whole
+    #  record table can be decoded at once. Otherwise, decode bin by bin.
+    if np.all(offsets[1:] == offsets[:-1] + counts[:-1] * BHD5_RECORD_SIZE):
+        records = np.frombuffer(header_str, dtype=BHD5_RECORD_DTYPE, 
+         count=int(counts.sum()), offset=int(offsets[0]) if bin_count > 0 else 0)
+    else:
+        records = np.concatenate([np.frombuffer(header_str, dtype=BHD5_RECORD_DTYPE, count=int(count), offset=int(offset)) 
+         for (count, offset) in zip(counts, offsets) if count > 0] or [np.zeros(0, dtype=BHD5_RECORD_DTYPE)])
+    
+    nonzero = np.flatnonzero(records["zero"])
+    if len(nonzero) > 0:
+        raise ValueError("Required record terminator is non-zero. Actual value is " + 
+         str(records["zero"][nonzero[0]]) + ".")
+    
+    table = np.zeros(len(records), dtype=[("hash", "<u4"), ("size", "<u4"), ("offset", "<u4")])
+    table["hash"] = records["hash"]
+    table["size"] = records["size"]
+    table["offset"] = records["offset"]
+    return table
 
-def parse_bhd5_header_to_dict(header):
+def bhd5_table_to_dict(table, unknown_records=None):
+    """Resolves the name of each record in a table from 
+     parse_bhd5_header_to_table.
+    
+    Returns a dictionary whose keys are filepaths, and whose
+     elements are tuples (offset, length) that determine the binary
+     data of that file inside the associated .bdt file.
+     
+    If a record hash is not in the name hash dictionary, raises a
+     ValueError, unless unknown_records is a list. In that case, the
+     record is named by get_unknown_record_name and a tuple
+     (hash, offset, length) is appended to unknown_records.
+    """
+    
+    # The filename table is large, so only load it once a .bhd5 header needs it.
+    import name_hash_handler
+    name_hash_index = name_hash_handler.get_name_hash_index()
+    
+    return_dict = {}
+    for (record_hash, record_size, record_offset) in zip(table["hash"].tolist(), 
+     table["size"].tolist(), table["offset"].tolist()):
+        try:
+            name = name_hash_index[record_hash]
+        except KeyError:
+            if unknown_records is None:
+                raise ValueError("Name hash " + hex(record_hash) + " was not found in the name hash dictionary.")
+            name = get_unknown_record_name(record_hash)
+            unknown_records.append((record_hash, record_offset, record_size))
+        return_dict[name] = (record_offset, record_size)
+    return return_dict
+
+def parse_bhd5_header_to_dict(header, unknown_records=None):
     """Parses a .bhd5 Dark Souls archive header file into a dictionary
      that indexes files in a .bdt Dark Souls archive file.
      
     Returns a dictionary whose keys are filepaths, and whose
      elements are tuples (offset, length) that determine the binary
-     data of that file inside the associated .bdt file.
+     data of that file inside the associated .bdt file. Records with
+     unknown name hashes are handled as in bhd5_table_to_dict.
     """
     
-    name_hash_dict = name_hash_handler.build_name_hash_dict()
+    return bhd5_table_to_dict(parse_bhd5_header_to_table(header), unknown_records)
+
+def parse_header_to_dict(header, unknown_records=None):
+    """Parses a .bhd5 or *bhd header file, whichever header is, into a
+     dictionary as in parse_bhd5_header_to_dict and parse_bhd_header_to_dict.
+    """
     
     with open(header, 'rb') as h:
-        header_str = h.read()
-    return_dict = {}
+        content = h.read()
+    return parse_header_content_to_dict(content, unknown_records)
+    
+def parse_header_content_to_dict(content, unknown_records=None):
+    """Parses the content of a .bhd5 or *bhd header file, as in
+     parse_header_to_dict.
+    """
+    
+    if archive_formats.BHF3_HEADER.has_magic(content):
+        return parse_bhd_content_to_dict(content)
+    elif archive_formats.BHD5_HEADER.has_magic(content):
+        return bhd5_table_to_dict(parse_bhd5_content_to_table(content), unknown_records)
+    else:
+        raise ValueError("Header file does not match known formats.")
+
+def check_bdt_header(content):
+    """Raises a ValueError if content does not begin with the header of a
+     *bdt data file.
+    """
+    
+    try:
+        archive_formats.BDF3_HEADER.unpack_from(content)
+    except ValueError:
+        raise ValueError("Header of data file is missing. Data file is possibly corrupt or malformed.")
+
+# Records separated by at most READ_RUN_MAX_GAP bytes are read from the
+#  .bdt together, in sequential runs of up to READ_RUN_MAX_SIZE bytes.
+READ_RUN_MAX_GAP = 64 * 1024
+READ_RUN_MAX_SIZE = 8 * 1024 * 1024
+# Records of at least this size are never read into memory whole, but are
+#  copied (or, for .dcx records, decompressed) straight from the .bdt to
+#  their output file.
+STREAM_RECORD_MIN_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def plan_sequential_reads(file_dict, max_gap=READ_RUN_MAX_GAP, max_run_size=READ_RUN_MAX_SIZE, 
+ stream_min_size=STREAM_RECORD_MIN_SIZE):
+    """Plans the reads needed to fetch every record in file_dict, a
+     dictionary as returned by parse_header_to_dict.
+     
+    Records are sorted by offset, and neighbouring records are merged into
+     runs that can each be read with a single sequential read. Records of
+     at least stream_min_size bytes are always given a run of their own.
+     Returns a list of tuples (run_offset, run_size, records), in offset 
+     order, where records is a list of tuples (name, offset, length) inside
+     that run.
+    """
+    
+    records = sorted(((name, record_offset, record_size) for (name, (record_offset, record_size)) 
+     in file_dict.iteritems()), key=lambda record: (record[1], record[2], record[0]))
+    
+    runs = []
+    for (name, record_offset, record_size) in records:
+        if len(runs) > 0 and record_size < stream_min_size:
+            (run_offset, run_size, run_records) = runs[-1]
+            run_end = run_offset + run_size
+            new_run_end = max(run_end, record_offset + record_size)
+            if (record_offset - run_end <= max_gap and new_run_end - run_offset <= max_run_size and 
+             run_records[0][2] < stream_min_size):
+                runs[-1] = (run_offset, new_run_end - run_offset, run_records)
+                run_records.append((name, record_offset, record_size))
+                continue
+        runs.append((record_offset, record_size, [(name, record_offset, record_size)]))
+    return runs
+
+def copy_record(src, offset, length, dst):
+    """Copies length bytes of the open file src, starting at offset, to the
+     open file dst at its current position.
+     
+    The data is copied in chunks through one reused buffer, so memory use
+     does not depend on length.
+    """
     
-    master_offset = 0
-    master_offset = consume_byte(header_str, master_offset, 'B', 1)
-    master_offset = consume_byte(header_str, master_offset, 'H', 1)
-    master_offset = consume_byte(header_str, master_offset, 'D', 1)
-    master_offset = consume_byte(header_str, master_offset, '5', 1)
-    master_offset = consume_byte(header_str, master_offset, '\xff', 1)
-    master_offset = consume_byte(header_str, master_offset, '\x00', 3)
-    master_offset = consume_byte(header_str, master_offset, '\x01', 1)
-    master_offset = consume_byte(header_str, master_offset, '\x00', 3)
-    
-    (file_size,) = struct.unpack_from("<I", header_str, offset=master_offset)
-    master_offset += struct.calcsize("<I")
-    (bin_count, bin_offset) = struct.unpack_from("<II", header_str, offset=master_offset)
-    master_offset += struct.calcsize("<II")
+    buf = bytearray(min(COPY_CHUNK_SIZE, length))
+    view = memoryview(buf)
+    src.seek(offset)
+    copied = 0
+    while copied < length:
+        count = src.readinto(view[:min(len(buf), length - copied)])
+        if not count:
+            raise ValueError("Record at offset " + hex(offset) + " is truncated.")
+        dst.write(view[:count])
+        copied += count
+
+class BdtArchive(object):
+    """Random-access reader for a .bdt archive file and its .bhd5/*bhd header.
+    
+    The header is parsed once and the .bdt is mmapped, so single files
+     can be read without unpacking the whole archive. Filepaths are as in
+     parse_header_to_dict, but are matched regardless of case and of the
+     path separator used.
+    """
+    
+    def __init__(self, header, data, unknown_records=None):
+        self._file_dict = parse_header_to_dict(header, unknown_records)
+        self._folded_names = None
+        
+        self._data_file = open(data, 'rb')
+        try:
+            self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            check_bdt_header(self._data)
+        except:
+            self.close()
+            raise
             
-    for _ in xrange(bin_count):
-        (bin_record_count, bin_record_offset) = struct.unpack_from("<II", header_str, offset=master_offset)
-        master_offset += struct.calcsize("<II")
-        for _ in xrange(bin_record_count):
-            (record_hash, record_size, record_offset, zero) = struct.unpack_from("<IIII", header_str, offset=bin_record_offset)
-            bin_record_offset += struct.calcsize("<IIII")
-            if zero != 0:
-                raise ValueError("Required record terminator is non-zero. Actual value is " + str(zero) + ".")
-            try:
-                name = name_hash_dict[record_hash]
-            except KeyError:
-                raise ValueError("Name hash " + hex(name_hash) + " was not found in the name hash dictionary.")
-            return_dict[name] = (record_offset, record_size)
-    return return_dict
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def close(self):
+        """Unmaps and closes the .bdt file."""
+        
+        if getattr(self, "_data", None) is not None:
+            self._data.close()
+            self._data = None
+        if self._data_file is not None:
+            self._data_file.close()
+            self._data_file = None
+        
+    def list(self):
+        """Returns a sorted list of the filepaths in the archive."""
+        
+        return sorted(self._file_dict.keys())
+        
+    def stat(self, name):
+        """Returns a tuple (offset, length) that determines the binary data 
+         of the file name inside the .bdt file. Raises a KeyError if the
+         archive has no such file.
+        """
+        
+        try:
+            return self._file_dict[name]
+        except KeyError:
+            pass
+        if self._folded_names is None:
+            self._folded_names = dict((self._fold_name(key), key) for key in self._file_dict)
+        return self._file_dict[self._folded_names[self._fold_name(name)]]
+        
+    def read(self, name, decompress=True, copy=True):
+        """Reads the file name from the archive. Raises a KeyError if the
+         archive has no such file.
+         
+        If decompress is True, .dcx content is decompressed into its
+         original form. Otherwise, or if the content is not .dcx, the raw
+         record is returned: as a string if copy is True, or as a read-only
+         view into the mmapped .bdt if copy is False.
+        """
+        
+        (record_offset, record_size) = self.stat(name)
+        content = archive_formats.get_view(self._data, record_offset, record_size)
+        if decompress and dcx_uncompresser.appears_dcx(content[0:4]):
+            return dcx_uncompresser.uncompress_dcx_content(content)
+        if copy:
+            return self._data[record_offset:record_offset + record_size]
+        return content
+        
+    @staticmethod
+    def _fold_name(name):
+        return name.replace('\\', '/').lower()
 
-def unpack_archive(header, data, basepath):
+def unpack_archive(header, data, basepath, unknown_records=None, path_filter=None, progress=None, 
+ output_dirs=None, writer=None, decompressor=None, budget=None, payload_handler=None, 
+ record_handler=None, file_handler=None, data_offset=0):
     """Unpacks the .bdt file data using the .bhd5/.bhd file header.
+    header may also be a dictionary already parsed from a header, as by
+    parse_header_to_dict. If data_offset is given, the .bdt file begins
+    at that offset of data, for a *bdt held inside another archive.
      
     Recursively creates directories relative to basepath for the unpacked
     files. Prints progress. Returns a list of files created. Automatically
     decompresses .dcx files into their original form.
+    
+    If unknown_records is a list, .bhd5 records with unknown name hashes
+    are unpacked into UNKNOWN_RECORD_DIR and listed in unknown_records
+    (see bhd5_table_to_dict), rather than aborting the unpack.
+    
+    If path_filter is given, only records whose filepath it returns True
+    for are read and unpacked.
+    
+    If progress is given, it is called as progress(count, total) after each
+    file is unpacked, instead of printing progress.
+    
+    Output directories are created up front from the header, through
+    output_dirs (an output_files.OutputDirectories, which may be shared
+    between calls) or a new one if it is not given.
+    
+    Files are written behind the reading through writer (an 
+    output_files.WriteBehindQueue using output_dirs). If writer is given,
+    the files may not all be written when this returns; call its flush
+    method before reading them. Otherwise, a new one is used and closed.
+    
+    .dcx records are decompressed, in whatever order they finish, by
+    decompressor (a dcx_uncompresser.DecompressionPool) if given, or 
+    otherwise by a new one.
+    
+    Records are read only as they fit in budget (a 
+    memory_budget.MemoryBudget), or in writer's budget if writer is given.
+    
+    If payload_handler is given, it is called as payload_handler(filename,
+    content) with the decompressed content of each file before it is 
+    written, so that it can be examined without reading it back. Files for
+    which it returns True are left to it and not written, but are still
+    listed, as in bnd_unpacker.unpack_bnd. Files of at least 
+    STREAM_RECORD_MIN_SIZE bytes are never held in memory, and are instead
+    passed to file_handler, if given, as file_handler(filename) once they
+    have been written.
+    
+    If record_handler is given, it is called as record_handler(filename,
+    data, offset, size, head) for each record as it is read, before it is
+    decompressed, where offset is the record's absolute offset in data and
+    head holds at least its first 4 bytes. Records for which it returns 
+    True are left to it, and are not unpacked or listed.
     """
     
     created_file_list = []
     
-    if appears_bhd(header):
-        file_dict = parse_bhd_header_to_dict(header)
-    elif appears_bhd5(header):
-        file_dict = parse_bhd5_header_to_dict(header)
+    if isinstance(header, dict):
+        file_dict = header
     else:
-        raise ValueError("Header file does not match known formats.")
-
+        file_dict = parse_header_to_dict(header, unknown_records)
+    if path_filter is not None:
+        file_dict = dict((name, file_dict[name]) for name in file_dict if path_filter(name))
+    if data_offset != 0:
+        file_dict = dict((name, (offset + data_offset, size)) for (name, (offset, size)) in file_dict.items())
     num_of_files = len(file_dict.keys())
-    print "   - Found " + str(num_of_files) + " records in header file."
+    if progress is None:
+        print "   - Found " + str(num_of_files) + " records in header file."
     
-    with open(data, 'rb') as d:
-        HEADER_STRING = "BDF307D7R6\x00\x00\x00\x00\x00\x00"
-        HEADER_OFFSET = len(HEADER_STRING)
+    if output_dirs is None:
+        output_dirs = output_files.OutputDirectories()
+    if writer is None:
+        writer = output_files.WriteBehindQueue(output_dirs, budget=budget)
+        owns_writer = True
+    else:
+        owns_writer = False
+    budget = writer.budget
+    if budget is None:
+        # Still account for what is read, so the reads stay in step.
+        budget = memory_budget.MemoryBudget()
+    if decompressor is None:
+        decompressor = dcx_uncompresser.DecompressionPool()
+        owns_decompressor = True
+    else:
+        owns_decompressor = False
+    # Bytes acquired from budget that this call has not yet released.
+    held = [0]
+    def acquire(size):
+        budget.acquire(size)
+        held[0] += size
+    def release(size):
+        held[0] -= size
+        budget.release(size)
+    
+    try:
+        output_dirs.prepare([output_files.fix_filename(basepath, name) for name in file_dict])
         
-        d.seek(0)
-        if d.read(HEADER_OFFSET) != HEADER_STRING:
-            raise ValueError("Header of data file is missing. Data file is possibly corrupt or malformed.")
+        read_plan = plan_sequential_reads(file_dict)
         
-        count = 0
-        for name in file_dict:
-            (record_offset, record_size) = file_dict[name]            
-            d.seek(record_offset)
-            content = d.read(record_size)
-            if dcx_uncompresser.appears_dcx(content):
-                content = dcx_uncompresser.uncompress_dcx_content(content)
-                if name[-4:] == ".dcx":
-                    name = name[:-4]
-            filename = fix_filename(basepath, name)
-            created_file_list.append(filename)
-            f = create_file(filename)
-            f.write(content)
-            f.close()
+        with open(data, 'rb') as d:
+            d.seek(data_offset)
+            check_bdt_header(d.read(archive_formats.BDF3_HEADER.size))
+            
+            def is_claimed(name, record_offset, record_size, head):
+                return record_handler is not None and record_handler(output_files.fix_filename(basepath, name), 
+                 data, record_offset, record_size, head)
             
-            count += 1
-            print "\r   - Unpacking files from archive (" + str(count) + "/" + str(num_of_files) + ")...",
-            sys.stdout.flush()
-        print "Done."
+            def read_records():
+                """Yields a tuple ((name, size, listed), content) for each record,
+                 where size bytes have been acquired from budget. Large records
+                 are instead streamed straight into their file, and yielded with
+                 their final name, size 0 and content None. Records claimed by
+                 record_handler are yielded with listed False, size 0 and 
+                 content None.
+                """
+                for (run_offset, run_size, records) in read_plan:
+                    # Large records are left on disk until we know what they hold.
+                    if len(records) == 1 and run_size >= STREAM_RECORD_MIN_SIZE:
+                        run = None
+                    else:
+                        acquire(run_size)
+                        d.seek(run_offset)
+                        run = d.read(run_size)
+                        # Only the records themselves stay charged, until written.
+                        release(run_size - sum(record_size for (_, _, record_size) in records))
+                    
+                    for (name, record_offset, record_size) in records:
+                        if run is not None:
+                            view = archive_formats.get_view(run, record_offset - run_offset, record_size)
+                            if is_claimed(name, record_offset, record_size, view[:4]):
+                                release(record_size)
+                                yield ((name, 0, False), None)
+                            else:
+                                yield ((name, record_size, True), view)
+                            continue
+                        
+                        d.seek(record_offset)
+                        head = d.read(4)
+                        if is_claimed(name, record_offset, record_size, head):
+                            yield ((name, 0, False), None)
+                            continue
+                        is_dcx = dcx_uncompresser.appears_dcx(head)
+                        if is_dcx and name[-4:] == ".dcx":
+                            name = name[:-4]
+                        f = output_dirs.open(output_files.fix_filename(basepath, name))
+                        if is_dcx:
+                            d.seek(record_offset)
+                            dcx_uncompresser.uncompress_dcx_stream(d, f)
+                        else:
+                            copy_record(d, record_offset, record_size, f)
+                        f.close()
+                        if file_handler is not None:
+                            file_handler(output_files.fix_filename(basepath, name))
+                        yield ((name, 0, True), None)
+            
+            count = 0
+            bytes_read = sum(run_size for (_, run_size, _) in read_plan)
+            start_time = time.time()
+            for ((name, record_size, listed), content, was_dcx) in decompressor.uncompress_all(read_records(), 
+             ordered=False):
+                if was_dcx and name[-4:] == ".dcx":
+                    name = name[:-4]
+                filename = output_files.fix_filename(basepath, name)
+                if listed:
+                    created_file_list.append(filename)
+                if content is not None:
+                    if payload_handler is None or not payload_handler(filename, content):
+                        # The writer now holds the content, and charges it itself.
+                        writer.write(filename, content)
+                    release(record_size)
+                
+                count += 1
+                if progress is None:
+                    print "\r   - Unpacking files from archive (" + str(count) + "/" + str(num_of_files) + ")...",
+                    sys.stdout.flush()
+                else:
+                    progress(count, num_of_files)
+    finally:
+        # Return whatever a failed unpack still holds, so that other 
+        #  unpacks sharing the budget do not wait for it forever.
+        if held[0] > 0:
+            budget.release(held[0])
+        if owns_decompressor:
+            decompressor.close()
+        if owns_writer:
+            writer.close()
+    
+    elapsed = max(time.time() - start_time, 1e-6)
+    throughput = "read %.1f MB at %.1f MB/s" % (bytes_read / 1048576.0, bytes_read / elapsed / 1048576.0)
+    log.info("Unpacked " + str(data) + ": " + throughput + ".")
+    if progress is None:
+        print "Done (" + throughput + ")."
     
     return created_file_list
@@ -0,0 +1,84 @@
+"""Compares walking a BND3 with thousands of members through
+ bnd_unpacker.unpack_bnd, which hands on views of the members and finds
+ each name with one search, against the original approach of copying
+ every member and building each name one character at a time.
+
+Files are not written, so that only the parsing and copying are timed.
+
+Usage: python benchmarks/bench_bnd_unpack.py [number of members] [repeats]
+"""
+
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bnd_unpacker
+
+def make_bnd3(num_of_members):
+    """Returns a generated BND3 file with flag 0x74 and num_of_members members."""
+
+    rng = random.Random(0)
+    names = ["N:\\FRPG\\data\\INTERROOT_win32\\chr\\c%04d\\hkx\\a%02d_%04d.hkx" % (i // 100, i % 100, i)
+     for i in xrange(num_of_members)]
+    sizes = [rng.randint(200, 4000) for _ in xrange(num_of_members)]
+
+    names_offset = 0x20 + 24 * num_of_members
+    names_blob = "".join(name + "\x00" for name in names)
+    data_offset = names_offset + len(names_blob)
+    header = "BND307D7R6\x00\x00" + struct.pack("<III", 0x74, num_of_members, data_offset) + "\x00" * 8
+    name_offset = names_offset
+    for (i, (name, size)) in enumerate(zip(names, sizes)):
+        header += struct.pack("<IIIIII", 0x40, size, data_offset, i, name_offset, size)
+        name_offset += len(name) + 1
+        data_offset += size
+    return header + names_blob + "".join("\xab" * size for size in sizes)
+
+def extract_strz_per_char(content, offset):
+    """The original per-character implementation, kept for comparison."""
+
+    extracted = ''
+    while content[offset] != '\x00':
+        extracted = extracted + content[offset]
+        offset += 1
+    return extracted
+
+def walk_copying(content):
+    """Walks the members of content as unpack_bnd originally did."""
+
+    (num_of_records,) = struct.unpack_from("<I", content, offset=0x10)
+    total = 0
+    for i in xrange(num_of_records):
+        (_, size, offset, _, name_offset, _) = struct.unpack_from("<IIIIII", content, offset=0x20 + 24 * i)
+        bnd_unpacker.relativize_filename(extract_strz_per_char(content, name_offset).replace('\\', '/'),
+         "/base", "/n_base")
+        total += len(content[offset:offset + size])
+    return total
+
+def walk_views(content):
+    """Walks the members of content with unpack_bnd."""
+
+    sizes = []
+    bnd_unpacker.unpack_bnd(content, "/base", "/n_base", write_files=False,
+     payload_handler=lambda filename, member: sizes.append(len(member)))
+    return sum(sizes)
+
+if __name__ == "__main__":
+    num_of_members = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    content = make_bnd3(num_of_members)
+    if walk_copying(content) != walk_views(content):
+        raise ValueError("unpack_bnd did not walk the same members.")
+
+    copying_time = min(timeit.repeat(lambda: walk_copying(content), number=1, repeat=repeats))
+    views_time = min(timeit.repeat(lambda: walk_views(content), number=1, repeat=repeats))
+
+    print "Walking a BND3 of " + str(num_of_members) + " members, " + str(len(content) // 1024) + \
+     " KB (best of " + str(repeats) + "):"
+    print " - Copies, per-character names: %8.2f ms" % (copying_time * 1000)
+    print " - Views, single name search:   %8.2f ms" % (views_time * 1000)
+    print " - Speedup:                     %8.1fx" % (copying_time / views_time)
@@ -0,0 +1,72 @@
+"""Measures .dcx decompression throughput of dcx_uncompresser.DecompressionPool
+ with 1, 2, 4 and 8 workers, using threads and processes, with ordered
+ and unordered results.
+
+The inputs are generated: files of text-like data, which compresses
+ about as well as typical game files, wrapped in .dcx headers.
+
+Usage: python benchmarks/bench_dcx_pool.py [number of files] [file size in KB]
+"""
+
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dcx_uncompresser
+
+WORKER_COUNTS = [1, 2, 4, 8]
+
+def make_dcx(content):
+    """Compresses content into the .dcx format read by dcx_uncompresser."""
+
+    compressed = zlib.compress(content, 9)
+    return ("DCX\x00" + struct.pack("<I", 0x100) + struct.pack(">III", 0x18, 0x24, 0x24) +
+     struct.pack(">I", 0x2c) + "DCS\x00" + struct.pack(">II", len(content), len(compressed)) +
+     "DCP\x00DFLT" + "\x00" * 0x18 + "DCA\x00" + struct.pack(">I", 8) + compressed)
+
+def make_inputs(num_of_files, file_size):
+    """Returns a list of tuples (tag, content) of generated .dcx files."""
+
+    rng = random.Random(0)
+    words = ["".join(chr(rng.randint(0x61, 0x7a)) for _ in xrange(rng.randint(2, 10))) for _ in xrange(4096)]
+    inputs = []
+    for i in xrange(num_of_files):
+        content = " ".join(rng.choice(words) for _ in xrange(file_size // 6))[:file_size]
+        inputs.append((i, make_dcx(content)))
+    return inputs
+
+def time_pool(inputs, workers, processes, ordered):
+    """Decompresses inputs once. Returns a tuple (seconds, bytes produced),
+     not counting starting and stopping the pool.
+    """
+
+    pool = dcx_uncompresser.DecompressionPool(workers, processes)
+    try:
+        start = time.time()
+        total = 0
+        for (_, content, _) in pool.uncompress_all(inputs, ordered):
+            total += len(content)
+        return (time.time() - start, total)
+    finally:
+        pool.close()
+
+if __name__ == "__main__":
+    num_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    file_size = (int(sys.argv[2]) if len(sys.argv) > 2 else 512) * 1024
+
+    inputs = make_inputs(num_of_files, file_size)
+    print "Decompressing " + str(num_of_files) + " .dcx files of " + str(file_size // 1024) + \
+     " KB (" + str(sum(len(content) for (_, content) in inputs) // 1024) + " KB compressed) on " + \
+     str(multiprocessing.cpu_count()) + " cores:"
+    for processes in [False, True]:
+        for ordered in [True, False]:
+            for workers in WORKER_COUNTS:
+                (elapsed, total) = time_pool(inputs, workers, processes, ordered)
+                print " - %-9s %-9s %d workers: %8.1f MB/s" % ("processes" if processes else "threads",
+                 "ordered" if ordered else "unordered", workers, total / elapsed / 1048576.0)
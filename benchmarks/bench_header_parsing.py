@@ -0,0 +1,67 @@
+"""Compares reading the record table of a BND3 with archive_formats, which
+ unpacks every record with one struct call per table, against the
+ original approach of one struct.unpack_from call per record, each
+ re-reading its format string.
+
+Only the records are unpacked, not their names, so that only the
+ parsing itself is timed.
+
+Usage: python benchmarks/bench_header_parsing.py [number of records] [repeats]
+"""
+
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_formats
+
+def make_record_table(num_of_records):
+    """Returns a generated BND3 header and record table with flag 0x74."""
+
+    header = "BND307D7R6\x00\x00" + struct.pack("<III", 0x74, num_of_records, 0) + "\x00" * 8
+    return header + "".join(struct.pack("<IIIIII", 0x40, i + 1, 0x1000 * i, i, 0x20 + i, i + 1)
+     for i in xrange(num_of_records))
+
+def unpack_per_record(content):
+    """Unpacks the records as read_bnd_index originally did."""
+
+    (magic_flag, num_of_records, _) = struct.unpack_from("<III", content, offset=0x0c)
+    master_offset = 0x20
+    records = []
+    for _ in xrange(num_of_records):
+        (record_sep, filedata_size, filedata_offset, file_id,
+         filename_offset, dummy_filedata_size) = struct.unpack_from("<IIIIII", content, offset=master_offset)
+        master_offset += struct.calcsize("<IIIIII")
+        if filedata_size != dummy_filedata_size:
+            raise ValueError("Mismatched sizes.")
+        if record_sep != 0x40:
+            raise ValueError("Unknown record separator.")
+        records.append((file_id, filename_offset, filedata_offset, filedata_size))
+    return records
+
+def unpack_layouts(content):
+    """Unpacks the records with archive_formats."""
+
+    (_, magic_flag, num_of_records, _) = archive_formats.BND3_HEADER.unpack_from(content)
+    return archive_formats.unpack_binder_records(content, archive_formats.BND3_HEADER.size,
+     magic_flag, num_of_records, "BND3")
+
+if __name__ == "__main__":
+    num_of_records = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    content = make_record_table(num_of_records)
+    if unpack_per_record(content) != unpack_layouts(content):
+        raise ValueError("archive_formats did not unpack the same records.")
+
+    per_record_time = min(timeit.repeat(lambda: unpack_per_record(content), number=1, repeat=repeats))
+    layouts_time = min(timeit.repeat(lambda: unpack_layouts(content), number=1, repeat=repeats))
+
+    print "Unpacking a BND3 record table of " + str(num_of_records) + " records (best of " + \
+     str(repeats) + "):"
+    print " - One unpack_from per record: %8.2f ms" % (per_record_time * 1000)
+    print " - Layouts, one call per table:%8.2f ms" % (layouts_time * 1000)
+    print " - Speedup:                    %8.1fx" % (per_record_time / layouts_time)
@@ -0,0 +1,54 @@
+"""Measures the start-up cost of importing the unpacker modules, and
+ checks that numpy and the filename table stay off the import path.
+
+Each import is timed in a fresh interpreter. For comparison, the cost
+ of eagerly importing numpy and name_hash_handler (what importing
+ bdt_unpacker used to pull in) is also shown.
+
+Usage: python benchmarks/bench_import_time.py [repeats]
+"""
+
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMING_SCRIPT = """
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+%s
+elapsed = time.time() - start
+print elapsed, int("numpy" in sys.modules), int("name_hash_handler" in sys.modules)
+"""
+
+STATEMENTS = [
+    "import bdt_unpacker",
+    "import unpacker_file_handler",
+    "import numpy, name_hash_handler",
+]
+
+def time_import(statement):
+    """Runs statement in a fresh interpreter. Returns a tuple
+     (seconds, imported_numpy, imported_name_hash_handler).
+    """
+
+    output = subprocess.check_output([sys.executable, "-c", TIMING_SCRIPT % (REPO_DIR, statement)])
+    (elapsed, has_numpy, has_names) = output.split()
+    return (float(elapsed), has_numpy == "1", has_names == "1")
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    # Warm up once so that every timed run uses compiled .pyc files.
+    for statement in STATEMENTS:
+        time_import(statement)
+
+    print "Import time (best of " + str(repeats) + " fresh interpreters):"
+    for statement in STATEMENTS:
+        results = [time_import(statement) for _ in xrange(repeats)]
+        (_, has_numpy, has_names) = results[0]
+        best = min(elapsed for (elapsed, _, _) in results)
+        print " - %-34s %8.2f ms  (numpy: %s, filename table: %s)" % (statement, best * 1000,
+         "yes" if has_numpy else "no", "yes" if has_names else "no")
@@ -0,0 +1,46 @@
+"""Compares the batched .bhd5 filepath hash against the original
+ per-character loop, over the full FILENAMES table.
+
+Usage: python benchmarks/bench_name_hash.py [repeats]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import name_hash_handler
+
+def get_hash_from_string_per_char(s):
+    """The original per-character implementation, kept for comparison."""
+
+    np.warnings.simplefilter("ignore", RuntimeWarning)
+
+    hash_val = np.uint32(0)
+    for char in bytearray(s.lower()):
+        hash_val *= np.uint32(37)
+        hash_val += np.uint32(char)
+    return hash_val.item()
+
+def per_char_dict():
+    return dict((get_hash_from_string_per_char(name), name) for name in name_hash_handler.FILENAMES)
+
+def batch_dict():
+    return name_hash_handler.build_name_hash_dict()
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    if per_char_dict() != batch_dict():
+        raise ValueError("Batched hashes do not match the per-character loop.")
+
+    per_char_time = min(timeit.repeat(per_char_dict, number=1, repeat=repeats))
+    batch_time = min(timeit.repeat(batch_dict, number=1, repeat=repeats))
+
+    print "Hashing " + str(len(name_hash_handler.FILENAMES)) + " filenames (best of " + str(repeats) + "):"
+    print " - Per-character loop: %8.2f ms" % (per_char_time * 1000)
+    print " - Batched columns:    %8.2f ms" % (batch_time * 1000)
+    print " - Speedup:            %8.1fx" % (per_char_time / batch_time)
@@ -1,118 +1,157 @@
+import mmap
 import os
 import sys
-import struct
 
-def consume_byte(content, offset, byte, length=1):
-    """Consume length bytes from content, starting at offset. If they
-     are not all byte, raises a ValueError.
-    """
-    
-    for i in xrange(0, length-1):
-        if content[offset + i] != byte:
-            raise ValueError("Expected byte '" + byte.encode("hex") + "' at offset " +\
-                    hex(offset + i) + " but received byte '" +\
-                    content[offset + i].encode("hex") + "'.")
-    return offset + length
-    
+import archive_formats
+import output_files
+
 def relativize_filename(filename, basepath, n_basepath):
     """Fixes the given filename and joins it with the appropriate basepath, 
     depending on if it is relative to DATA or N:
     """
     
     if len(filename) >= 2 and filename[0:2].upper() == "N:":
-        return fix_filename(n_basepath, filename[2:])
+        return output_files.fix_filename(n_basepath, filename[2:])
     else:
-        return fix_filename(basepath, filename)
-    
-def fix_filename(base, filepath):
-    """Joins filepath to base, and converts to the system's path separator."""
+        return output_files.fix_filename(basepath, filename)
     
-    # Append ./ to filepath so that it is correctly joined with base.
-    #  If filepath begins with /, this prevents base from being ignored.
-    return os.path.normpath(os.path.join(base, "./" + filepath))
+def appears_bnd(content):
+    """Checks if the magic bytes at the start of content indicate that it
+    is a BND3-packed file.
+    """
+    return archive_formats.BND3_HEADER.has_magic(content)
 
-def create_file(filename):
-    """Attempts to create filename."""
+class BndIndex(object):
+    """The table of files in a BND3-packed file, as read by read_bnd_index.
     
-    path = os.path.dirname(filename)
-    
-    try:
-        os.makedirs(path)
-    except OSError:
-        if not os.path.isdir(path):
-            raise
+    records is a list of tuples (file_id, filepath, offset, size), in the
+     order they appear in the file, where filepath uses / separators and
+     offset and size determine the file's data inside content. Filepaths
+     are matched regardless of case and of the path separator used.
+    """
     
-    f = open(filename, "wb+")
-    return f
+    def __init__(self, content, records):
+        self.content = content
+        self.records = records
+        self._folded_names = None
+        
+    def __len__(self):
+        return len(self.records)
+        
+    def __iter__(self):
+        return iter(self.records)
+        
+    def list(self):
+        """Returns a list of the filepaths in the file, in file order."""
+        
+        return [filepath for (_, filepath, _, _) in self.records]
+        
+    def stat(self, name):
+        """Returns a tuple (file_id, filepath, offset, size) for the file
+         name. Raises a KeyError if there is no such file.
+        """
+        
+        if self._folded_names is None:
+            self._folded_names = {}
+            for record in self.records:
+                self._folded_names.setdefault(self._fold_name(record[1]), record)
+        return self._folded_names[self._fold_name(name)]
+        
+    def read_member(self, name, copy=True):
+        """Reads the file name. Raises a KeyError if there is no such file.
+        
+        Returns a string if copy is True, or otherwise a read-only view
+         of content.
+        """
+        
+        (_, _, offset, size) = self.stat(name)
+        view = archive_formats.get_view(self.content, offset, size)
+        if not copy:
+            return view
+        if isinstance(view, memoryview):
+            return view.tobytes()
+        return view[:]
+        
+    @staticmethod
+    def _fold_name(name):
+        return name.replace('\\', '/').lower()
+        
+def read_bnd_index(content):
+    """Reads the table of files in the *bnd file content from a BND3-packed
+    file, without reading the files themselves. content may be a string,
+    or an mmap or view of the file. Returns a BndIndex. Raises ValueError 
+    if the table does not match the required format.
+    """
     
-def extract_strz(content, offset):
-    extracted = ''
-    while content[offset] != '\x00':
-        extracted = extracted + content[offset]
-        offset += 1
-    return extracted
+    records = []
     
-def appears_bnd(content):
-    """Checks if the magic bytes at the start of content indicate that it
-    is a BND3-packed file.
-    """
-    return content[0:4] == "BND3"
+    (_, magic_flag, num_of_records, _) = archive_formats.BND3_HEADER.unpack_from(content)
+    for (file_id, filename_offset, filedata_offset, filedata_size) in archive_formats.unpack_binder_records(content, 
+     archive_formats.BND3_HEADER.size, magic_flag, num_of_records, "BND3"):
+        filename = archive_formats.extract_strz(content, filename_offset).replace('\\', '/')
+        records.append((file_id, filename, filedata_offset, filedata_size))
+    return BndIndex(content, records)
 
-def unpack_bnd(content, basepath, n_basepath):
-    """Unpacks the *bnd file content from a BND3-packed file.
+def unpack_bnd(content, basepath, n_basepath, path_filter=None, output_dirs=None, writer=None, 
+ payload_handler=None, write_files=True):
+    """Unpacks the *bnd file content from a BND3-packed file. content may be
+    a string, or an mmap or view of the file, from which the files are 
+    written without being copied.
      
     Recursively creates directories relative to basepath for the unpacked
     files. Files that have a full N: path are instead placed relative to n_basepath.
-    Returns a list of files created.
+    If path_filter is given, only files whose filepath it returns True for
+    are unpacked. The directories are all created, through output_dirs if
+    given, before any file is written. Returns a list of files created.
+    
+    If writer (an output_files.WriteBehindQueue using output_dirs) is
+    given, the files are written through it, and may not all be written
+    when this returns.
+    
+    If payload_handler is given, it is called as payload_handler(filename,
+    content) for each file before it is written. Files for which it returns
+    True are left to it and not written, but are still listed.
+    
+    If write_files is False, no files or directories are created at all,
+    and the list of files that would have been created is returned.
     """
     
     created_file_list = []
-       
-    master_offset = 0
-    master_offset = consume_byte(content, master_offset, 'B', 1)
-    master_offset = consume_byte(content, master_offset, 'N', 1)
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, '3', 1)
-    
-    # Skip the version number.
-    master_offset = 0x0c
-    (magic_flag, num_of_records, filename_end_offset) = struct.unpack_from("<III", content, offset=master_offset)
-    master_offset += struct.calcsize("<III")
-    if not (magic_flag == 0x74 or magic_flag == 0x54 or magic_flag == 0x70):
-        raise ValueError("File has unknown BND3 magic flag: " + hex(magic_flag))
-    
-    # Skip to the records.
-    master_offset = 0x20
+    records = []
     
     count = 0
-    for _ in xrange(num_of_records):
-        if magic_flag == 0x74 or magic_flag == 0x54:
-            (record_sep, filedata_size, filedata_offset, file_id, 
-             filename_offset, dummy_filedata_size) = struct.unpack_from("<IIIIII", content, offset=master_offset)
-            master_offset += struct.calcsize("<IIIIII")
-            if filedata_size != dummy_filedata_size:
-                raise ValueError("File has malformed record structure. File data size " + 
-                 str(filedata_size) + " does not match dummy file data size " + 
-                 str(dummy_filedata_size) + ".")
-        else: # magic_flag == 0x70
-            (record_sep, filedata_size, filedata_offset, file_id, 
-             filename_offset) = struct.unpack_from("<IIIII", content, offset=master_offset)
-            master_offset += struct.calcsize("<IIIII")
-        
-        if record_sep != 0x40:
-            raise ValueError("File has malformed record structure. Record" + 
-            " has unknown record separator " + hex(record_sep))
-            
-        filename = extract_strz(content, filename_offset).replace('\\', '/')
-        filedata = content[filedata_offset:filedata_offset + filedata_size]
+    for (_, filename, filedata_offset, filedata_size) in read_bnd_index(content):
+        if path_filter is not None and not path_filter(filename):
+            continue
         filename_to_use = relativize_filename(filename, basepath, n_basepath)
-            
+        records.append((filename_to_use, filedata_offset, filedata_size))
+    
+    if not write_files:
+        for (filename_to_use, filedata_offset, filedata_size) in records:
+            created_file_list.append(filename_to_use)
+            if payload_handler is not None:
+                payload_handler(filename_to_use, archive_formats.get_view(content, filedata_offset, filedata_size))
+        return created_file_list
+    
+    if output_dirs is None:
+        output_dirs = output_files.OutputDirectories()
+    if writer is None:
+        writer = output_files.WriteBehindQueue(output_dirs)
+        owns_writer = True
+    else:
+        owns_writer = False
+    output_dirs.prepare([filename_to_use for (filename_to_use, _, _) in records])
+    
+    for (filename_to_use, filedata_offset, filedata_size) in records:
+        filedata = archive_formats.get_view(content, filedata_offset, filedata_size)
         created_file_list.append(filename_to_use)
-        f = create_file(filename_to_use)
-        f.write(filedata)
-        f.flush()
-        f.close()
+        if payload_handler is not None and payload_handler(filename_to_use, filedata):
+            continue
+        writer.write(filename_to_use, filedata)
         count += 1
+    
+    if owns_writer:
+        writer.close()
     return created_file_list
     
 if __name__ == "__main__":
@@ -122,10 +161,10 @@ if __name__ == "__main__":
         filepath = sys.argv[1]
         (directory, filename) = os.path.split(os.path.abspath(filepath))
         with open(filepath, 'rb') as f:
-            file_content = f.read()
+            file_content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             file_list = unpack_bnd(file_content, 
              os.path.join(directory, filename + '.extract'), 
-             os.path.join(directory, filename + '.n_extract'), filename)
+             os.path.join(directory, filename + '.n_extract'))
         print "  - Created file list:"
         for filename in file_list:
             print "  - " + str(filename)
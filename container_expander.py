@@ -0,0 +1,410 @@
+import logging
+log = logging.getLogger(__name__)
+
+import mmap
+import os
+import threading
+import traceback
+
+import archive_formats
+import bdt_unpacker
+import bnd_unpacker
+import dcx_uncompresser
+import output_files
+import path_filter
+
+# Container formats, by the magic bytes that their files begin with.
+MAGIC_SIZE = 4
+CONTAINER_MAGICS = [(format_name, layout.magic[:MAGIC_SIZE]) for (format_name, layout) in [
+    ("DCX", archive_formats.DCX_HEADER),
+    ("BND3", archive_formats.BND3_HEADER),
+    ("BHF3", archive_formats.BHF3_HEADER),
+    ("BHD5", archive_formats.BHD5_HEADER),
+    ("BDF3", archive_formats.BDF3_HEADER),
+]]
+# The formats of the header files of BDT/BHD pairs, whose data files are BDF3.
+PAIR_HEADER_FORMATS = ["BHF3", "BHD5"]
+
+# Default limit on how deeply nested a file may be for the containers
+#  holding it to be expanded. Files in the top-level archives are at depth 1.
+DEFAULT_MAX_DEPTH = 8
+
+def detect_format(content):
+    """Returns the name of the format in CONTAINER_MAGICS that content
+    begins with, or None if it is not a container. content may be a string,
+    or an mmap or view of the file, and needs only to hold its first
+    MAGIC_SIZE bytes.
+    """
+
+    magic = content[:MAGIC_SIZE]
+    if isinstance(magic, memoryview):
+        magic = magic.tobytes()
+    for (format_name, format_magic) in CONTAINER_MAGICS:
+        if magic == format_magic:
+            return format_name
+    return None
+
+def get_pair_key(filename):
+    """Returns the key that matches the data file of a BDT/BHD pair to its
+     header file: its name without the directory, or the bdt, bhd or bhd5
+     that ends its extension.
+    """
+
+    (root, ext) = os.path.splitext(os.path.basename(filename))
+    for suffix in ["bhd5", "bdt", "bhd"]:
+        if ext.lower().endswith(suffix):
+            return root + ext[:-len(suffix)]
+    return root + ext
+
+def copy_content(content):
+    """Returns content (a string, mmap or view) as a string, so that it
+     does not keep the file it is a view of alive.
+    """
+
+    if isinstance(content, memoryview):
+        return content.tobytes()
+    return content[:]
+
+class ContainerExpander(object):
+    """Expands the containers among unpacked files, recognizing them by their
+     magic bytes (see detect_format), along with the containers nested inside
+     them, for files nested up to max_depth deep.
+
+    BND3 files are expanded as soon as they are found, on pool (a
+     multiprocessing.Pool) if given. .dcx files are looked through for a
+     container inside. The two halves of each BDT/BHD pair are held, headers
+     in memory and data files by their location, until expand_pairs, as
+     either may be found first. Files are written through output_dirs and
+     writer; those of BND3 files only if write_bnd_files is True, though
+     they are listed either way. The data files of pairs are always written,
+     to be read back by expand_pairs, which then removes them.
+
+    routes determines where the files of each container go. It is a list of
+     tuples (format_name, pattern, destination), where format_name is "BND3",
+     or "BDF3" for a pair, which is routed by its data file. The first route
+     whose glob pattern (see path_filter.glob_to_regex) matches the
+     container's filepath relative to root_dir is used. Its files then go
+     into the directory destination, relative to root_dir, in which
+     "{directory}" stands for the directory holding the container. Files of
+     a BND3 that have a full N: path go into n_basepath instead.
+
+    If selection (a path_filter.PathFilter) is given, the files inside
+     containers are only checked against its exclude patterns: by their
+     own full paths in a BND3, or by their paths inside destination in a pair.
+    """
+
+    def __init__(self, routes, root_dir, n_basepath, max_depth=DEFAULT_MAX_DEPTH, selection=None,
+     write_bnd_files=True, output_dirs=None, writer=None, pool=None):
+        self.routes = routes
+        self.root_dir = root_dir
+        self.n_basepath = n_basepath
+        self.max_depth = max_depth
+        self.selection = selection
+        self.write_bnd_files = write_bnd_files
+        self.output_dirs = output_dirs
+        self.writer = writer
+        self.pool = pool
+        # Maps each expanded BND3 filepath to the list of its files.
+        self.expansions = {}
+        # Map each pair key to a tuple (filepath, depth, content) for the
+        #  header, and (filepath, depth, data_file, offset, size) for the data.
+        self.pair_headers = {}
+        self.pair_data = {}
+        self._compiled_routes = [(format_name, path_filter.glob_to_regex(pattern), destination)
+         for (format_name, pattern, destination) in routes]
+        self._pending = {}
+        self._collected = set()
+        self._expanded_pairs = set()
+        self._lock = threading.Lock()
+
+    def get_config(self):
+        """Returns the arguments that recreate this expander, without its
+         output or pool, as in expand_bnd_task.
+        """
+
+        return (self.routes, self.root_dir, self.n_basepath, self.max_depth, self.selection,
+         self.write_bnd_files)
+
+    def find_route(self, format_name, filepath):
+        """Returns the directory that the files of the container filepath, of
+         format format_name, go into. Raises a ValueError if no route matches.
+        """
+
+        rel_path = os.path.relpath(os.path.abspath(filepath), self.root_dir)
+        path = path_filter.normalize_path(rel_path)
+        for (route_format, regex, destination) in self._compiled_routes:
+            if route_format == format_name and regex.match(path):
+                destination = destination.replace("{directory}", os.path.dirname(rel_path))
+                return os.path.normpath(os.path.join(self.root_dir, destination))
+        raise ValueError("No route for the files of " + format_name + " file \"" + str(filepath) + "\".")
+
+    def add_pair_header(self, filepath, depth, content):
+        """Holds content, the header of the pair of filepath, unless it is
+         already known.
+        """
+
+        with self._lock:
+            self.pair_headers.setdefault(get_pair_key(filepath), (filepath, depth, content))
+
+    def add_pair_data(self, filepath, depth, data_file, offset, size):
+        """Records that the data of the pair of filepath is size bytes at
+         offset of data_file, unless it is already known.
+        """
+
+        with self._lock:
+            self.pair_data.setdefault(get_pair_key(filepath), (filepath, depth, data_file, offset, size))
+
+    def expand(self, filepath, content, depth, written=True):
+        """Expands filepath, a file at depth whose content (a string, mmap or
+         view) is given, if it is a container. written tells if the file
+         is written out as filepath; if not, and it is the data file of a
+         pair, it is written out here.
+
+        Returns True if the file is kept by the expander (the header of a
+         pair), and need not be written.
+        """
+
+        format_name = detect_format(content)
+        if format_name == "DCX":
+            # Only inflate the whole file if it holds a container.
+            if detect_format(dcx_uncompresser.peek_dcx_content(content, MAGIC_SIZE)) is None:
+                return False
+            content = dcx_uncompresser.uncompress_dcx_content(content)
+            if filepath[-4:] == ".dcx":
+                filepath = filepath[:-4]
+            # The .dcx file itself is not kept, whatever it holds.
+            self.expand(filepath, content, depth, False)
+            return False
+        elif format_name == "BND3":
+            self.expand_bnd(filepath, content, depth)
+        elif format_name in PAIR_HEADER_FORMATS:
+            self.add_pair_header(filepath, depth, copy_content(content))
+            return True
+        elif format_name == "BDF3":
+            if not written:
+                # Pairs are unpacked from their data file on disk, so it is
+                #  written out even when the files around it are not, until
+                #  expand_pairs removes it.
+                self.writer.write(filepath, content)
+            self.add_pair_data(filepath, depth, filepath, 0, len(content))
+        return False
+
+    def payload_handler(self, depth, written=True):
+        """Returns a payload_handler for bdt_unpacker.unpack_archive or
+         bnd_unpacker.unpack_bnd, that expands files at depth (see expand).
+        """
+
+        return lambda filename, content: self.expand(filename, content, depth, written)
+
+    def record_handler(self, depth):
+        """Returns a record_handler for bdt_unpacker.unpack_archive, for
+         files at depth. It claims the halves of pairs, reading headers into
+         memory but leaving data in place.
+        """
+
+        def handle_record(filename, data, offset, size, head):
+            format_name = detect_format(head)
+            if format_name == "BDF3":
+                self.add_pair_data(filename, depth, data, offset, size)
+            elif format_name in PAIR_HEADER_FORMATS:
+                with open(data, 'rb') as d:
+                    d.seek(offset)
+                    self.add_pair_header(filename, depth, d.read(size))
+            else:
+                return False
+            return True
+        return handle_record
+
+    def file_handler(self, depth):
+        """Returns a file_handler for bdt_unpacker.unpack_archive, that
+         expands files at depth after they are written.
+        """
+
+        def handle_file(filename):
+            with open(filename, 'rb') as f:
+                format_name = detect_format(f.read(MAGIC_SIZE))
+                if format_name == "BND3":
+                    # Leave it on disk, to be mapped by whoever expands it.
+                    self.expand_bnd(filename, None, depth)
+                elif format_name is not None:
+                    f.seek(0)
+                    self.expand(filename, f.read(), depth)
+        return handle_file
+
+    def expand_bnd(self, filepath, content, depth):
+        """Expands the BND3 file filepath at depth, from content, or from
+         disk if content is None. On pool, the result is merged by collect.
+        """
+
+        if depth >= self.max_depth:
+            log.warning("Not expanding " + str(filepath) + ", which is nested " + str(depth) + " deep.")
+            return
+        basepath = self.find_route("BND3", filepath)
+        log.info("Unpack " + str(filepath))
+        if self.pool is None:
+            self.expand_bnd_members(filepath, content, depth, basepath)
+            return
+
+        # Views cannot be sent to the workers, so the content is copied,
+        #  and counted against the budget until the worker is done.
+        if content is not None:
+            content = copy_content(content)
+        budget = self.writer.budget
+        size = len(content) if content is not None and budget is not None else 0
+        if size > 0:
+            budget.charge(size)
+        result = self.pool.apply_async(expand_bnd_task, ((self.get_config(), filepath, content, depth, basepath),),
+         callback=lambda _: budget.discharge(size) if size > 0 else None)
+        with self._lock:
+            self._pending[filepath] = result
+
+    def expand_bnd_members(self, filepath, content, depth, basepath):
+        """Unpacks the files of the BND3 file filepath, from content or from
+         disk if content is None, into basepath, and expands those that are
+         containers in turn.
+        """
+
+        if content is None:
+            # The files are written from views of the mmap, which therefore is
+            #  not closed here, but once the last of them has been written.
+            with open(filepath, 'rb') as f:
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        new_file_list = bnd_unpacker.unpack_bnd(content, basepath, self.n_basepath,
+         self.selection.inherited() if self.selection is not None else None, self.output_dirs, self.writer,
+         self.payload_handler(depth + 1, self.write_bnd_files), self.write_bnd_files)
+        with self._lock:
+            self.expansions[filepath] = new_file_list
+
+    def collect(self, progress=None):
+        """Waits for every BND3 file being expanded on pool, and merges the
+         results in filepath order, so that they do not depend on which
+         finished first.
+
+        If progress is given, it is called as progress(count, total,
+         filepath) for each BND3 file expanded since the last call.
+
+        Raises a RuntimeError, holding the worker's traceback, if a worker
+         failed.
+        """
+
+        with self._lock:
+            filepaths = sorted((set(self.expansions) | set(self._pending)) - self._collected)
+        for count, filepath in enumerate(filepaths):
+            with self._lock:
+                result = self._pending.pop(filepath, None)
+            if result is not None:
+                (succeeded, result) = result.get()
+                if not succeeded:
+                    raise RuntimeError("Expanding " + str(filepath) + " failed in a worker process:\n" + result)
+                (expansions, pair_headers, pair_data) = result
+                with self._lock:
+                    self.expansions.update(expansions)
+                    for key in sorted(pair_headers):
+                        self.pair_headers.setdefault(key, pair_headers[key])
+                    for key in sorted(pair_data):
+                        self.pair_data.setdefault(key, pair_data[key])
+                    # Nested BND3 files were expanded by the same worker.
+                    self._collected.update(expansions)
+            self._collected.add(filepath)
+            if progress is not None:
+                progress(count + 1, len(filepaths), filepath)
+
+    def expand_pairs(self, decompressor, progress=None):
+        """Expands every BDT/BHD pair whose two halves have been found, in
+         filepath order, along with the containers inside them, until no
+         more are found. .dcx files in the pairs are decompressed by
+         decompressor (a dcx_uncompresser.DecompressionPool).
+
+        If progress is given, it is called as progress(count, total,
+         bdt_file, bhd_file) before each pair is expanded.
+
+        Data files that were written out on their own, rather than held in
+         an archive, are removed once their pair has been expanded.
+
+        Raises a ValueError if a data file has no header, unless selection
+         is given, since the header may then not have been selected. Headers
+         with no data file are written out as they are, with a warning.
+        """
+
+        while True:
+            self.collect()
+            # Data files from BND3 files are read back from disk.
+            self.writer.flush()
+            pairs = []
+            with self._lock:
+                for key in self.pair_data.keys():
+                    if key in self._expanded_pairs:
+                        continue
+                    self._expanded_pairs.add(key)
+                    (bdt_file, data_depth, data_file, data_offset, _) = self.pair_data[key]
+                    if key not in self.pair_headers:
+                        if self.selection is None:
+                            raise ValueError("BDT File \"" + str(bdt_file) + "\" has no corresponding header file.")
+                        log.info("Skipping BDT file '" + str(bdt_file) + "' with no selected header file.")
+                        continue
+                    (bhd_file, header_depth, bhd_content) = self.pair_headers[key]
+                    log.info("bdt/bhd pair for '" + str(bdt_file) + "': " + str(bhd_file))
+                    pairs.append((bdt_file, data_file, data_offset, max(data_depth, header_depth),
+                     bhd_file, bhd_content))
+            if len(pairs) == 0:
+                break
+
+            for count, (bdt_file, data_file, data_offset, depth, bhd_file, bhd_content) in enumerate(sorted(pairs)):
+                if progress is not None:
+                    progress(count + 1, len(pairs), bdt_file, bhd_file)
+                if depth >= self.max_depth:
+                    log.warning("Not expanding " + str(bdt_file) + ", which is nested " + str(depth) + " deep.")
+                    continue
+                log.info("Unpack " + str(bdt_file) + " via " + str(bhd_file))
+                directory = self.find_route("BDF3", bdt_file)
+                unknown_records = []
+                bdt_unpacker.unpack_archive(bdt_unpacker.parse_header_content_to_dict(bhd_content, unknown_records),
+                 data_file, directory, data_offset=data_offset,
+                 path_filter=self.selection.inherited(os.path.relpath(directory, self.root_dir))
+                 if self.selection is not None else None,
+                 output_dirs=self.output_dirs, writer=self.writer, decompressor=decompressor,
+                 payload_handler=self.payload_handler(depth + 1), record_handler=self.record_handler(depth + 1),
+                 file_handler=self.file_handler(depth + 1))
+                if len(unknown_records) > 0:
+                    log.warning(" " + str(len(unknown_records)) + " records in " + str(bdt_file) +
+                     " had unknown name hashes.")
+                if data_file == bdt_file:
+                    os.remove(data_file)
+
+        with self._lock:
+            unmatched = sorted(self.pair_headers[key] for key in self.pair_headers if key not in self.pair_data)
+        for (bhd_file, _, bhd_content) in unmatched:
+            log.warning("Header file '" + str(bhd_file) + "' has no corresponding BDT file, so is written as is.")
+            self.writer.write(bhd_file, bhd_content)
+
+# The output directories and writer used by expand_bnd_task in each pool
+#  worker process, created when first needed.
+_worker_output = None
+
+def expand_bnd_task(task):
+    """Expands one BND3 file in a pool worker process. task is a tuple
+     (config, filepath, content, depth, basepath), where config is from
+     ContainerExpander.get_config, and the rest are as for
+     ContainerExpander.expand_bnd_members. Nested BND3 files are expanded
+     by the same worker, and every file has been written when this returns.
+
+    Returns a tuple (succeeded, result), where result is the formatted
+     traceback on failure, or otherwise a tuple (expansions, pair_headers,
+     pair_data) of the worker's ContainerExpander.
+    """
+
+    global _worker_output
+    try:
+        (config, filepath, content, depth, basepath) = task
+        if _worker_output is None:
+            worker_output_dirs = output_files.OutputDirectories()
+            _worker_output = (worker_output_dirs, output_files.WriteBehindQueue(worker_output_dirs))
+        (output_dirs, writer) = _worker_output
+
+        expander = ContainerExpander(*config, output_dirs=output_dirs, writer=writer)
+        expander.expand_bnd_members(filepath, content, depth, basepath)
+        writer.flush()
+        return (True, (expander.expansions, expander.pair_headers, expander.pair_data))
+    except Exception:
+        # The traceback is lost when the exception is sent back, so send its text.
+        return (False, traceback.format_exc())
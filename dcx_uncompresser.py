@@ -1,84 +1,219 @@
-import struct
+import collections
 import zlib
 import sys
 import os
+import traceback
+
+import archive_formats
+
+# Size of the .dcx header, up to and including the two zlib header bytes
+#  that precede the raw deflate data.
+DCX_HEADER_SIZE = archive_formats.DCX_HEADER.size
+# How much compressed data uncompress_dcx_stream reads, and how much
+#  uncompressed data it produces, at a time.
+DCX_STREAM_CHUNK_SIZE = 1024 * 1024
+# How much compressed data peek_dcx_content inflates at a time.
+DCX_PEEK_CHUNK_SIZE = 1024
+# How many files DecompressionPool.uncompress_all keeps waiting on its
+#  workers, per worker.
+DCX_PENDING_PER_WORKER = 2
 
-def consume_byte(content, offset, byte, length=1):
-    """Consume length bytes from content, starting at offset. If they
-     are not all byte, raises a ValueError.
-    """
-    
-    for i in xrange(0, length-1):
-        if content[offset + i] != byte:
-            raise ValueError("Expected byte '" + byte.encode("hex") + "' at offset " +\
-                    hex(offset + i) + " but received byte '" +\
-                    content[offset + i].encode("hex") + "'.")
-    return offset + length
-    
 def appears_dcx(content):
     """Checks if the magic bytes at the start of content indicate that it
     is a .dcx file.
     """
-    return content[0:4] == "DCX\x00"
+    return archive_formats.DCX_HEADER.has_magic(content)
    
+def parse_dcx_header(content):
+    """Parses the header at the start of the file content from a .dcx file.
+    Returns a tuple (data_offset, comp_size, uncomp_size) describing the 
+    raw deflate data. Raises ValueError if the header does not match the
+    required format.
+    """
+    (_, uncomp_size, comp_size, _, zlib_flags) = archive_formats.DCX_HEADER.unpack_from(content)
+    if ((0x78 << 8) | zlib_flags) % 31 != 0:
+        raise ValueError("DCX header has an invalid zlib header check: " + hex(zlib_flags))
+    comp_size -= 2  # The zlib header is included in the compressed data, for some reason.
+    
+    return (DCX_HEADER_SIZE, comp_size, uncomp_size)
+    
 def uncompress_dcx_content(content):
     """Decompress the file content from a .dcx file. Returns the uncompressed
     content. Raising ValueError if the header does not match the required format.
     """
-    master_offset = 0
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, 'C', 1)
-    master_offset = consume_byte(content, master_offset, 'X', 1)
-    master_offset = consume_byte(content, master_offset, '\x00', 1)
-    
-    (req_1,) = struct.unpack_from("<I", content, offset=master_offset)
-    master_offset += struct.calcsize("<I")
-    (req_2, req_3, req_4) = struct.unpack_from(">III", content, offset=master_offset)
-    master_offset += struct.calcsize(">III")
-    if req_1 != 0x100:
-        raise ValueError("Expected DCX header int 0x100, but received " + hex(req_1))
-    if req_2 != 0x18:
-        raise ValueError("Expected DCX header int 0x18, but received " + hex(req_2))
-    if req_3 != 0x24:
-        raise ValueError("Expected DCX header int 0x24, but received " + hex(req_3))
-    if req_4 != 0x24:
-        raise ValueError("Expected DCX header int 0x24, but received " + hex(req_4))
-    
-    (header_length,) = struct.unpack_from(">I", content, offset=master_offset)
-    master_offset += struct.calcsize(">I")
-    
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, 'C', 1)
-    master_offset = consume_byte(content, master_offset, 'S', 1)
-    master_offset = consume_byte(content, master_offset, '\x00', 1)
-    
-    (uncomp_size, comp_size) = struct.unpack_from(">II", content, offset=master_offset)
-    master_offset += struct.calcsize(">II")
-    
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, 'C', 1)
-    master_offset = consume_byte(content, master_offset, 'P', 1)
-    master_offset = consume_byte(content, master_offset, '\x00', 1)
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, 'F', 1)
-    master_offset = consume_byte(content, master_offset, 'L', 1)
-    master_offset = consume_byte(content, master_offset, 'T', 1)
-    
-    # Skip the portion of the header whose meaning is unknown.
-    master_offset += 0x18
-    master_offset = consume_byte(content, master_offset, 'D', 1)
-    master_offset = consume_byte(content, master_offset, 'C', 1)
-    master_offset = consume_byte(content, master_offset, 'A', 1)
-    master_offset = consume_byte(content, master_offset, '\x00', 1)
-    (comp_header_length,) = struct.unpack_from(">I", content, offset=master_offset)
-    master_offset += struct.calcsize(">I")
-    
-    master_offset = consume_byte(content, master_offset, '0x78', 1)
-    master_offset = consume_byte(content, master_offset, '0xDA', 1)
-    comp_size -= 2  # The previous two bytes are included in the compressed data, for some reason.
+    (data_offset, comp_size, uncomp_size) = parse_dcx_header(content)
+    
+    decomp_obj = zlib.decompressobj(-15)
+    return decomp_obj.decompress(content[data_offset:data_offset + comp_size], uncomp_size)
+    
+def peek_dcx_content(content, size):
+    """Decompress only the first size bytes of the file content from a .dcx
+    file, inflating no more of it than needed. Returns them, or all of the
+    uncompressed content if it is shorter. Raises ValueError if the header
+    does not match the required format.
+    """
+    (data_offset, comp_size, uncomp_size) = parse_dcx_header(content)
+    size = min(size, uncomp_size)
     
     decomp_obj = zlib.decompressobj(-15)
-    return decomp_obj.decompress(content[master_offset:master_offset + comp_size], uncomp_size)
+    peeked = ""
+    offset = data_offset
+    end = data_offset + comp_size
+    while len(peeked) < size and offset < end:
+        chunk = content[offset:min(offset + DCX_PEEK_CHUNK_SIZE, end)]
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        offset += len(chunk)
+        peeked += decomp_obj.decompress(chunk, size - len(peeked))
+    return peeked
+    
+def uncompress_dcx_stream(src, dst, chunk_size=DCX_STREAM_CHUNK_SIZE):
+    """Decompress a .dcx file read from the open file src, starting at its
+    current position, into the open file dst. Returns the number of bytes
+    written. Raises ValueError if the header does not match the required
+    format or the compressed data is truncated.
+    
+    The data is passed through in pieces of at most chunk_size bytes, so
+    memory use does not depend on the size of the file.
+    """
+    header = src.read(DCX_HEADER_SIZE)
+    if len(header) < DCX_HEADER_SIZE:
+        raise ValueError("DCX header is truncated.")
+    (data_offset, comp_size, uncomp_size) = parse_dcx_header(header)
+    
+    decomp_obj = zlib.decompressobj(-15)
+    remaining = comp_size
+    written = 0
+    while remaining > 0 and written < uncomp_size:
+        chunk = src.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError("DCX compressed data is truncated.")
+        remaining -= len(chunk)
+        # Limit each piece of output, so that highly compressed data does
+        #  not expand into one huge string.
+        while chunk and written < uncomp_size:
+            piece = decomp_obj.decompress(chunk, min(chunk_size, uncomp_size - written))
+            dst.write(piece)
+            written += len(piece)
+            chunk = decomp_obj.unconsumed_tail
+    if written < uncomp_size:
+        piece = decomp_obj.flush()[:uncomp_size - written]
+        dst.write(piece)
+        written += len(piece)
+    return written
+    
+def _uncompress_dcx_task(content):
+    """Runs uncompress_dcx_content in a pool worker. Returns a tuple 
+    (succeeded, result), where result is the formatted traceback on 
+    failure, so that errors reach the caller whether or not results are
+    waited on in order.
+    """
+    try:
+        return (True, uncompress_dcx_content(content))
+    except Exception:
+        # The traceback is lost when the exception is sent back, so send its text.
+        return (False, traceback.format_exc())
+    
+class DecompressionPool(object):
+    """Decompresses .dcx file content on a pool of workers.
+    
+    zlib releases the GIL while it works, so threads (the default) scale
+    with the number of cores without copying the content. Set processes
+    to True to use worker processes instead. The pool may be shared
+    between threads, with each calling uncompress_all.
+    """
+    
+    def __init__(self, workers=None, processes=False):
+        import multiprocessing
+        import multiprocessing.pool
+        
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = max(1, workers)
+        self.processes = processes
+        if processes:
+            self._pool = multiprocessing.Pool(self.workers)
+        else:
+            self._pool = multiprocessing.pool.ThreadPool(self.workers)
+        
+    def uncompress_all(self, items, ordered=True, max_pending=None):
+        """Decompresses the content of each tuple (tag, content) in the 
+        iterable items. Yields a tuple (tag, content, was_dcx) for each,
+        where content has been decompressed if was_dcx is True. Content 
+        that is not .dcx, or is None, is passed through unchanged.
+        
+        Results are yielded in the order of items if ordered is True, and
+        otherwise as soon as they are ready. items is only read ahead by
+        max_pending files (by default, DCX_PENDING_PER_WORKER per worker),
+        so memory use stays bounded however many there are. Raises a 
+        RuntimeError naming the tag and holding the worker's traceback for
+        the first file that fails to decompress.
+        """
+        import Queue
+        
+        if max_pending is None:
+            max_pending = self.workers * DCX_PENDING_PER_WORKER
+        
+        # Entries are (tag, async_result, content), where async_result is 
+        #  None for content passed through unchanged.
+        pending = collections.deque()
+        completed = Queue.Queue()
+        num_pending = 0
+        
+        for (tag, content) in items:
+            if content is None or not appears_dcx(content):
+                if ordered:
+                    pending.append((tag, None, content))
+                else:
+                    yield (tag, content, False)
+            else:
+                if self.processes:
+                    # Buffers cannot be pickled for the worker processes.
+                    content = str(content)
+                callback = (lambda result, tag=tag: completed.put((tag, result))) if not ordered else None
+                async_result = self._pool.apply_async(_uncompress_dcx_task, (content,), callback=callback)
+                if ordered:
+                    pending.append((tag, async_result, None))
+                num_pending += 1
+            
+            # Hand back whatever is ready, waiting if too much is pending.
+            if ordered:
+                while len(pending) > 0 and (pending[0][1] is None or pending[0][1].ready() or 
+                 num_pending >= max_pending):
+                    (result_tag, async_result, content) = pending.popleft()
+                    if async_result is None:
+                        yield (result_tag, content, False)
+                    else:
+                        num_pending -= 1
+                        yield (result_tag, self._get_result(result_tag, async_result.get()), True)
+            else:
+                while num_pending > 0 and (num_pending >= max_pending or not completed.empty()):
+                    (result_tag, result) = completed.get()
+                    num_pending -= 1
+                    yield (result_tag, self._get_result(result_tag, result), True)
+        
+        while len(pending) > 0:
+            (result_tag, async_result, content) = pending.popleft()
+            if async_result is None:
+                yield (result_tag, content, False)
+            else:
+                yield (result_tag, self._get_result(result_tag, async_result.get()), True)
+        while num_pending > 0 and not ordered:
+            (result_tag, result) = completed.get()
+            num_pending -= 1
+            yield (result_tag, self._get_result(result_tag, result), True)
+        
+    def close(self):
+        """Stops the workers, once any work in progress has finished."""
+        self._pool.close()
+        self._pool.join()
+        
+    @staticmethod
+    def _get_result(tag, result):
+        (succeeded, value) = result
+        if not succeeded:
+            raise RuntimeError("Decompressing " + str(tag) + " failed in a worker:\n" + value)
+        return value
     
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -90,8 +225,7 @@ if __name__ == "__main__":
         else:
             uncomp_filename = filename + ".undcx"
         with open(filename, "rb") as f, open(uncomp_filename, "wb") as g:
-            file_content = f.read()
-            g.write(uncompress_dcx_content(file_content))
+            uncompress_dcx_stream(f, g)
             g.close()
             
     
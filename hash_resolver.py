@@ -0,0 +1,268 @@
+import multiprocessing
+import re
+import sys
+import time
+
+import numpy as np
+
+import name_hash_handler
+
+# A template is a filepath with fields in braces. Each field is a comma
+#  separated list of alternatives, where an alternative may be a numeric
+#  range such as 0000-9999. Ranges whose ends have the same number of
+#  digits are zero-padded to that width.
+TEMPLATE_FIELD = re.compile(r"\{([^{}]*)\}")
+NUMERIC_RANGE = re.compile(r"^(\d+)-(\d+)$")
+HASH_TOKEN = re.compile(r"\b(?:0x)?([0-9a-fA-F]{1,8})\b")
+
+HASH_MASK = 0xffffffff
+
+# The trailing fields of a template are combined into a table of at most
+#  this many entries, which is checked against every prefix at once.
+TAIL_SIZE_LIMIT = 1 << 20
+# Roughly how many candidates a single worker task should check, and the
+#  minimum number of tasks to give each process, for load balancing.
+CANDIDATES_PER_TASK = 1 << 24
+TASKS_PER_PROCESS = 4
+
+def expand_field(field):
+    """Expands the contents of a template field into its list of alternatives."""
+
+    alternatives = []
+    for part in field.split(","):
+        match = NUMERIC_RANGE.match(part)
+        if match:
+            (start, end) = match.groups()
+            width = len(start) if len(start) == len(end) else 0
+            alternatives.extend(str(n).zfill(width) for n in xrange(int(start), int(end) + 1))
+        else:
+            alternatives.append(part)
+    return alternatives
+
+def parse_template(template):
+    """Splits template into a list of segments, where each segment is a
+     list of the alternative strings that may appear at that point.
+    """
+
+    segments = []
+    position = 0
+    for match in TEMPLATE_FIELD.finditer(template):
+        if match.start() > position:
+            segments.append([template[position:match.start()]])
+        segments.append(expand_field(match.group(1)))
+        position = match.end()
+    if position < len(template):
+        segments.append([template[position:]])
+    return segments
+
+def get_segment_hash_parts(segment):
+    """Returns a tuple (multipliers, addends) for the alternatives in segment.
+
+    The .bhd5 hash is a running multiply-add, so appending a string t to
+     a string with hash h gives the hash h * 37**len(t) + hash(t). Each
+     alternative therefore reduces to a multiplier and an addend.
+    """
+
+    multipliers = [pow(37, len(alternative), HASH_MASK + 1) for alternative in segment]
+    addends = [name_hash_handler.get_hash_from_string(alternative) for alternative in segment]
+    return (multipliers, addends)
+
+def build_tail_table(segments):
+    """Combines segments into one table of every combination of their
+     alternatives. Returns numpy arrays (multipliers, addends), indexed in
+     mixed radix order with the last segment varying fastest.
+    """
+
+    multipliers = np.ones(1, dtype=np.uint64)
+    addends = np.zeros(1, dtype=np.uint64)
+    for segment in segments:
+        (segment_multipliers, segment_addends) = get_segment_hash_parts(segment)
+        segment_multipliers = np.array(segment_multipliers, dtype=np.uint64)
+        segment_addends = np.array(segment_addends, dtype=np.uint64)
+        addends = (np.outer(addends, segment_multipliers) + segment_addends).ravel() & HASH_MASK
+        multipliers = np.outer(multipliers, segment_multipliers).ravel() & HASH_MASK
+    return (multipliers, addends)
+
+def split_template(segments):
+    """Splits segments into a tuple (prefix_segments, tail_segments), where
+     the tail is the longest run of trailing segments whose combinations
+     fit in TAIL_SIZE_LIMIT, and always contains at least one segment.
+    """
+
+    split = len(segments) - 1
+    tail_size = len(segments[-1])
+    while split > 0 and tail_size * len(segments[split - 1]) <= TAIL_SIZE_LIMIT:
+        split -= 1
+        tail_size *= len(segments[split])
+    return (segments[:split], segments[split:])
+
+def decode_index(index, radices):
+    """Converts index into a list of digits in the mixed radix radices,
+     with the last digit varying fastest.
+    """
+
+    digits = [0] * len(radices)
+    for i in xrange(len(radices) - 1, -1, -1):
+        (index, digits[i]) = divmod(index, radices[i])
+    return digits
+
+_search_state = None
+
+def init_search(template, targets):
+    """Prepares the per-process search state for template and the
+     collection of target hashes.
+    """
+
+    global _search_state
+    segments = parse_template(template)
+    (prefix_segments, tail_segments) = split_template(segments)
+    (tail_multipliers, tail_addends) = build_tail_table(tail_segments)
+    _search_state = {
+        "prefix_segments": prefix_segments,
+        "prefix_parts": [get_segment_hash_parts(segment) for segment in prefix_segments],
+        "tail_segments": tail_segments,
+        "tail_multipliers": tail_multipliers,
+        "tail_addends": tail_addends,
+        "targets": np.array(sorted(set(targets)), dtype=np.uint64),
+    }
+
+def search_prefix_range(prefix_range):
+    """Checks every candidate whose prefix index is in prefix_range, a
+     tuple (start, stop), against the target hashes.
+
+    The hash of each prefix level is kept on a stack, so stepping to the
+     next prefix only rehashes the segments that changed. Returns a tuple
+     (matches, candidates_checked) where matches is a list of tuples
+     (hash, filepath).
+    """
+
+    (start, stop) = prefix_range
+    state = _search_state
+    prefix_segments = state["prefix_segments"]
+    prefix_parts = state["prefix_parts"]
+    tail_segments = state["tail_segments"]
+    tail_multipliers = state["tail_multipliers"]
+    tail_addends = state["tail_addends"]
+    targets = state["targets"]
+
+    radices = [len(segment) for segment in prefix_segments]
+    tail_radices = [len(segment) for segment in tail_segments]
+    digits = decode_index(start, radices)
+
+    hash_stack = [0] * (len(prefix_segments) + 1)
+    changed = 0
+    matches = []
+    for _ in xrange(start, stop):
+        for level in xrange(changed, len(prefix_segments)):
+            (multipliers, addends) = prefix_parts[level]
+            hash_stack[level + 1] = (hash_stack[level] * multipliers[digits[level]] +
+             addends[digits[level]]) & HASH_MASK
+
+        candidates = (tail_multipliers * np.uint64(hash_stack[-1]) + tail_addends) & HASH_MASK
+        positions = np.minimum(np.searchsorted(targets, candidates), len(targets) - 1)
+        for tail_index in np.flatnonzero(targets[positions] == candidates):
+            tail_digits = decode_index(int(tail_index), tail_radices)
+            name = "".join([segment[digit] for (segment, digit) in zip(prefix_segments, digits)] +
+             [segment[digit] for (segment, digit) in zip(tail_segments, tail_digits)])
+            matches.append((int(candidates[tail_index]), name))
+
+        # Step to the next prefix, noting the first level that changed.
+        level = len(prefix_segments) - 1
+        while level >= 0:
+            digits[level] += 1
+            if digits[level] < radices[level]:
+                break
+            digits[level] = 0
+            level -= 1
+        changed = max(level, 0)
+    return (matches, (stop - start) * len(tail_multipliers))
+
+def resolve_hashes(targets, template, processes=None):
+    """Searches every filepath described by template for ones whose
+     .bhd5 hash is in targets, using a pool of processes (by default, one
+     per core).
+
+    Returns a tuple (matches, candidates_checked) where matches is a
+     sorted list of tuples (hash, filepath).
+    """
+
+    targets = list(targets)
+    if len(targets) == 0:
+        return ([], 0)
+
+    segments = parse_template(template)
+    (prefix_segments, tail_segments) = split_template(segments)
+    prefix_count = 1
+    for segment in prefix_segments:
+        prefix_count *= len(segment)
+    tail_size = 1
+    for segment in tail_segments:
+        tail_size *= len(segment)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    prefixes_per_task = max(1, min(CANDIDATES_PER_TASK // tail_size,
+     -(-prefix_count // (processes * TASKS_PER_PROCESS))))
+    tasks = [(start, min(start + prefixes_per_task, prefix_count))
+     for start in xrange(0, prefix_count, prefixes_per_task)]
+
+    if processes <= 1 or len(tasks) <= 1:
+        init_search(template, targets)
+        results = [search_prefix_range(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes, init_search, (template, targets))
+        try:
+            results = pool.map(search_prefix_range, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    matches = []
+    candidates_checked = 0
+    for (task_matches, task_candidates) in results:
+        matches += task_matches
+        candidates_checked += task_candidates
+    return (sorted(matches), candidates_checked)
+
+def read_hash_list(filename):
+    """Reads the hashes listed in filename, such as the report written by
+     unpacker_file_handler.write_unknown_hash_report. Lines beginning with
+     # are ignored. Only the first hash-like token on each line is used.
+    """
+
+    hashes = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            for token in line.split():
+                match = HASH_TOKEN.match(token)
+                if match and match.end() == len(token):
+                    hashes.append(int(match.group(1), 16))
+                    break
+    return hashes
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) < 3:
+        print "Usage: " + str(sys.argv[0]) + " <Hash list file> <Template> [<Template> ...]"
+        print "  e.g. " + str(sys.argv[0]) + " unpackDS-unknown-hashes.txt \"/chr/c{0000-9999}.chrbnd.dcx\""
+    else:
+        unresolved = set(read_hash_list(sys.argv[1]))
+        print "Resolving " + str(len(unresolved)) + " hashes."
+        found = []
+        for template in sys.argv[2:]:
+            start_time = time.time()
+            (matches, candidates_checked) = resolve_hashes(unresolved, template)
+            elapsed = max(time.time() - start_time, 1e-6)
+            print " - Template \"" + template + "\": checked " + str(candidates_checked) + " candidates (" + \
+             str(int(candidates_checked / elapsed)) + "/s), found " + str(len(matches)) + " matches."
+            for (name_hash, name) in matches:
+                unresolved.discard(name_hash)
+            found += matches
+
+        print "Matches to add to name_hash_handler.FILENAMES:"
+        for (name_hash, name) in sorted(found, key=lambda match: match[1]):
+            print " \"" + name + "\", "
+        print str(len(unresolved)) + " hashes remain unresolved."
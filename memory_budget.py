@@ -0,0 +1,85 @@
+import threading
+
+# Default limit on the bytes of file content held in memory by an unpack.
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+class MemoryBudget(object):
+    """Accounts for the bytes of file content held in memory by the stages
+     of an unpack, and limits them to limit bytes (or not at all if limit
+     is None). Safe to share between threads.
+
+    Producers, which read data in, call acquire before reading and release
+     once they have handed the data on. acquire blocks while the budget is
+     exceeded. Downstream stages, such as writers, call charge and
+     discharge instead, which never block, so that a full budget cannot
+     stop the stages that would free it.
+
+    To avoid deadlock, acquire does not wait for bytes that are held by
+     producers which are themselves waiting, since those will never be
+     released. A single request larger than the whole limit is allowed
+     once nothing else can be freed.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._held = {}
+        self._waiting_held = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        """Reserves size bytes for the calling producer thread, waiting
+         until they fit within the limit.
+        """
+
+        thread_id = threading.current_thread().ident
+        with self._condition:
+            held = self._held.get(thread_id, 0)
+            if self._must_wait(size):
+                self._waiting_held += held
+                # Our bytes now count as unreleasable, which may let
+                #  another waiting producer continue.
+                self._condition.notify_all()
+                try:
+                    while self._must_wait(size):
+                        self._condition.wait()
+                finally:
+                    self._waiting_held -= held
+            self._held[thread_id] = held + size
+            self._add(size)
+
+    def release(self, size):
+        """Returns size bytes reserved by acquire on the calling thread."""
+
+        thread_id = threading.current_thread().ident
+        with self._condition:
+            held = self._held.get(thread_id, 0) - size
+            if held > 0:
+                self._held[thread_id] = held
+            else:
+                self._held.pop(thread_id, None)
+            self._add(-size)
+
+    def charge(self, size):
+        """Counts size bytes held by a downstream stage, without waiting."""
+
+        with self._condition:
+            self._add(size)
+
+    def discharge(self, size):
+        """Returns size bytes counted by charge."""
+
+        with self._condition:
+            self._add(-size)
+
+    def _must_wait(self, size):
+        return (self.limit is not None and self.used + size > self.limit and
+         self.used > self._waiting_held)
+
+    def _add(self, size):
+        self.used += size
+        if self.used > self.peak:
+            self.peak = self.used
+        if size < 0:
+            self._condition.notify_all()
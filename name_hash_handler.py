@@ -1,4 +1,14 @@
-import numpy as np
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+NAME_HASH_INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "name_hash_index.bin")
+NAME_HASH_INDEX_MAGIC = "NHI1"
+# Magic, SHA1 digest of FILENAMES, record count, string table size.
+NAME_HASH_INDEX_HEADER = struct.Struct("<4s20sII")
+UINT32 = struct.Struct("<I")
 
 FILENAMES = [
  "/chr/c0000.anibnd.dcx",
@@ -6137,13 +6147,39 @@ def get_hash_from_string(s):
     Hashes the string s and returns the value.
     """
     
-    np.warnings.simplefilter("ignore", RuntimeWarning)
-    
-    hash_val = np.uint32(0)
+    hash_val = 0
     for char in bytearray(s.lower()):
-        hash_val *= np.uint32(37)
-        hash_val += np.uint32(char)
-    return hash_val.item()
+        hash_val = (hash_val * 37 + char) & 0xffffffff
+    return hash_val
+
+def get_hashes_from_strings(strings):
+    """Implements the Dark Souls .bhd5 filepath hash function over a whole
+     sequence of strings at once.
+    
+    The strings are left-padded with null bytes to a common length and
+     hashed one column at a time. Leading null bytes leave a hash of zero
+     unchanged, so no per-string masking is needed. Returns a numpy array
+     of uint32 hashes, in the same order as strings.
+    """
+    
+    # numpy is only needed for bulk hashing, so keep it off the import path.
+    import numpy as np
+    
+    lowered = [s.lower() for s in strings]
+    hash_vals = np.zeros(len(lowered), dtype=np.uint32)
+    if len(lowered) == 0:
+        return hash_vals
+    
+    width = max(len(s) for s in lowered)
+    padded = ''.join(s.rjust(width, '\x00') for s in lowered)
+    # Transpose so that each column of characters is contiguous in memory.
+    columns = np.frombuffer(padded, dtype=np.uint8).reshape(len(lowered), width).T.astype(np.uint32)
+    
+    multiplier = np.uint32(37)
+    for column in columns:
+        hash_vals *= multiplier
+        hash_vals += column
+    return hash_vals
 
 def build_name_hash_dict():
     """Builds a dictionary that translates known Dark Souls .bhd5 filepath
@@ -6153,7 +6189,149 @@ def build_name_hash_dict():
      as the value for that key.
     """
     
-    name_hash_dict = {}
-    for name in FILENAMES:
-        name_hash_dict[get_hash_from_string(name)] = name
-    return name_hash_dict
+    return dict(zip(get_hashes_from_strings(FILENAMES).tolist(), FILENAMES))
+
+def get_filenames_digest():
+    """Returns the SHA1 digest of FILENAMES, used to detect a stale index."""
+    
+    return hashlib.sha1("\n".join(FILENAMES)).digest()
+
+def build_name_hash_index():
+    """Compiles FILENAMES into the binary name hash index format.
+    
+    The index is a header, a sorted array of uint32 hashes, an array of
+     count + 1 uint32 offsets into the string table, and the string table
+     itself. Returns the index as a string.
+    """
+    
+    name_hash_dict = build_name_hash_dict()
+    sorted_hashes = sorted(name_hash_dict.keys())
+    names = [name_hash_dict[name_hash] for name_hash in sorted_hashes]
+    
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    string_table = "".join(names)
+    
+    header = NAME_HASH_INDEX_HEADER.pack(NAME_HASH_INDEX_MAGIC, get_filenames_digest(),
+     len(names), len(string_table))
+    return (header + struct.pack("<" + str(len(sorted_hashes)) + "I", *sorted_hashes) +
+     struct.pack("<" + str(len(offsets)) + "I", *offsets) + string_table)
+
+def write_name_hash_index(filename):
+    """Writes a freshly compiled name hash index to filename, replacing
+     any existing file only once the new one is complete.
+    """
+    
+    temp_filename = filename + "." + str(os.getpid()) + ".tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(build_name_hash_index())
+    try:
+        os.rename(temp_filename, filename)
+    except OSError:
+        # Windows will not rename over an existing file.
+        os.remove(filename)
+        os.rename(temp_filename, filename)
+
+def index_is_current(filename):
+    """Checks if filename is a name hash index built from the current FILENAMES."""
+    
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(NAME_HASH_INDEX_HEADER.size)
+    except IOError:
+        return False
+    if len(header) != NAME_HASH_INDEX_HEADER.size:
+        return False
+    (magic, digest, _, _) = NAME_HASH_INDEX_HEADER.unpack(header)
+    return magic == NAME_HASH_INDEX_MAGIC and digest == get_filenames_digest()
+
+class NameHashIndex(object):
+    """Read-only view of a compiled name hash index, searched by binary search.
+    
+    Behaves like the dictionary from build_name_hash_dict, translating
+     known .bhd5 filepath hashes into their filepaths.
+    """
+    
+    def __init__(self, content):
+        (magic, _, count, string_table_size) = NAME_HASH_INDEX_HEADER.unpack_from(content, 0)
+        if magic != NAME_HASH_INDEX_MAGIC:
+            raise ValueError("Name hash index has unknown magic bytes.")
+        
+        self._content = content
+        self._count = count
+        self._hashes_offset = NAME_HASH_INDEX_HEADER.size
+        self._offsets_offset = self._hashes_offset + 4 * count
+        self._string_table_offset = self._offsets_offset + 4 * (count + 1)
+        if len(content) != self._string_table_offset + string_table_size:
+            raise ValueError("Name hash index is truncated or malformed.")
+        
+    def __len__(self):
+        return self._count
+        
+    def __contains__(self, name_hash):
+        return self._find(name_hash) is not None
+        
+    def __getitem__(self, name_hash):
+        i = self._find(name_hash)
+        if i is None:
+            raise KeyError(name_hash)
+        return self._name_at(i)
+        
+    def get(self, name_hash, default=None):
+        i = self._find(name_hash)
+        if i is None:
+            return default
+        return self._name_at(i)
+        
+    def _find(self, name_hash):
+        low = 0
+        high = self._count
+        while low < high:
+            mid = (low + high) // 2
+            (mid_hash,) = UINT32.unpack_from(self._content, self._hashes_offset + 4 * mid)
+            if mid_hash < name_hash:
+                low = mid + 1
+            elif mid_hash > name_hash:
+                high = mid
+            else:
+                return mid
+        return None
+        
+    def _name_at(self, i):
+        (start, end) = struct.unpack_from("<II", self._content, self._offsets_offset + 4 * i)
+        return self._content[self._string_table_offset + start:self._string_table_offset + end]
+
+# The NameHashIndex shared by get_name_hash_index, loaded on first use.
+_name_hash_index = None
+_name_hash_index_lock = threading.Lock()
+
+def load_name_hash_index(filename=NAME_HASH_INDEX_FILE):
+    """Loads the name hash index at filename with mmap, first rebuilding
+     it if it is missing or was built from a different FILENAMES.
+    
+    If the index cannot be written (e.g. a read-only install), it is
+     compiled in memory instead. Returns a NameHashIndex.
+    """
+    
+    if not index_is_current(filename):
+        try:
+            write_name_hash_index(filename)
+        except (IOError, OSError):
+            return NameHashIndex(build_name_hash_index())
+    
+    with open(filename, "rb") as f:
+        content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return NameHashIndex(content)
+
+def get_name_hash_index():
+    """Returns the NameHashIndex for FILENAMES, loading it on first use.
+    
+    The index is shared by every caller in the process.
+    """
+    
+    global _name_hash_index
+    with _name_hash_index_lock:
+        if _name_hash_index is None:
+            _name_hash_index = load_name_hash_index()
+        return _name_hash_index
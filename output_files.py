@@ -0,0 +1,177 @@
+import collections
+import os
+import sys
+import threading
+
+# Default number of threads that WriteBehindQueue writes files with, and
+#  how many bytes of file content it holds before write blocks.
+DEFAULT_WRITE_WORKERS = 4
+DEFAULT_MAX_BYTES_IN_FLIGHT = 64 * 1024 * 1024
+
+def fix_filename(base, filepath):
+    """Joins filepath to base, and converts to the system's path separator."""
+
+    # Append ./ to filepath so that it is correctly joined with base.
+    #  If filepath begins with /, this prevents base from being ignored.
+    return os.path.normpath(os.path.join(base, "./" + filepath))
+
+class OutputDirectories(object):
+    """Creates the directories for a set of output files once each, and
+     opens output files inside them.
+
+    Call prepare with the planned output filenames before writing them:
+     each parent directory is then created exactly once, in sorted order,
+     rather than os.makedirs being tried for every file. Safe to share
+     between threads.
+    """
+
+    def __init__(self):
+        self._created = set()
+        self._lock = threading.Lock()
+
+    def prepare(self, filenames):
+        """Creates every directory needed to hold filenames."""
+
+        with self._lock:
+            needed = set()
+            for filename in filenames:
+                path = os.path.dirname(filename)
+                while path and path not in self._created and path not in needed:
+                    needed.add(path)
+                    parent = os.path.dirname(path)
+                    if parent == path:
+                        break
+                    path = parent
+
+            # Sorting puts every directory after its parent.
+            for path in sorted(needed):
+                try:
+                    os.mkdir(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+            self._created.update(needed)
+
+    def open(self, filename):
+        """Opens filename for writing, creating its directory if prepare was
+         not told about it. Returns a file object.
+        """
+
+        path = os.path.dirname(filename)
+        if path and path not in self._created:
+            self.prepare([filename])
+        return open(filename, "wb")
+
+class WriteBehindQueue(object):
+    """Writes output files on a pool of worker threads, so that the caller
+     can read and decompress the next file while earlier ones are written.
+
+    Files are opened through output_dirs (an OutputDirectories). write
+     blocks while more than max_bytes_in_flight bytes of content are
+     waiting to be written, unless nothing is waiting, so a single file
+     larger than the limit is still accepted. If a write fails, the error
+     is raised by the next call to write, flush or close.
+
+    If budget (a memory_budget.MemoryBudget) is given, queued content is
+     charged to it until written.
+    """
+
+    def __init__(self, output_dirs, workers=DEFAULT_WRITE_WORKERS, 
+     max_bytes_in_flight=DEFAULT_MAX_BYTES_IN_FLIGHT, budget=None):
+        self.output_dirs = output_dirs
+        self.budget = budget
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self._pending = collections.deque()
+        self._bytes_in_flight = 0
+        self._files_in_flight = 0
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = [threading.Thread(target=self._run) for _ in xrange(max(1, workers))]
+        for thread in self._threads:
+            # Workers only ever wait on the queue, so they must not keep
+            #  the process alive if the caller fails without closing it.
+            thread.daemon = True
+            thread.start()
+
+    def write(self, filename, content):
+        """Queues content (a string or buffer) to be written to filename."""
+
+        size = len(content)
+        with self._condition:
+            while (self._error is None and self._files_in_flight > 0 and 
+             self._bytes_in_flight + size > self.max_bytes_in_flight):
+                self._condition.wait()
+            self._raise_error()
+            if self._closed:
+                raise ValueError("Cannot write " + str(filename) + " to a closed WriteBehindQueue.")
+            if self.budget is not None:
+                self.budget.charge(size)
+            self._pending.append((filename, content))
+            self._bytes_in_flight += size
+            self._files_in_flight += 1
+            self._condition.notify_all()
+
+    def flush(self):
+        """Waits until every queued file has been written."""
+
+        with self._condition:
+            while self._error is None and self._files_in_flight > 0:
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self):
+        """Writes every queued file, then stops the worker threads."""
+
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+
+    def _raise_error(self):
+        if self._error is not None:
+            (exc_type, exc_value, exc_traceback) = self._error
+            raise exc_type, exc_value, exc_traceback
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+                (filename, content) = self._pending.popleft()
+
+            try:
+                f = self.output_dirs.open(filename)
+                try:
+                    f.write(content)
+                finally:
+                    f.close()
+            except Exception:
+                with self._condition:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+                    self._condition.notify_all()
+
+            if self.budget is not None:
+                self.budget.discharge(len(content))
+            with self._condition:
+                self._bytes_in_flight -= len(content)
+                self._files_in_flight -= 1
+                self._condition.notify_all()
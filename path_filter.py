@@ -0,0 +1,87 @@
+import re
+
+def normalize_path(path):
+    """Converts an archive filepath into the form that patterns are matched
+     against: lowercase, / separated, and beginning with /.
+    """
+
+    path = path.replace('\\', '/').lower()
+    if len(path) >= 2 and path[0:2] == "n:":
+        path = path[2:]
+    if not path.startswith("/"):
+        path = "/" + path
+    return path
+
+def glob_to_regex(pattern):
+    """Translates a glob pattern into a compiled regular expression.
+
+    ** matches any run of characters, including /, and **/ also matches
+     no directories at all. * and ? match any run of characters and any
+     single character, respectively, within one path component. A pattern
+     ending in / matches everything beneath that directory.
+    """
+
+    pattern = normalize_path(pattern)
+    if pattern.endswith("/"):
+        pattern += "**"
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r"\Z")
+
+class PathFilter(object):
+    """Selects archive filepaths by include and exclude glob patterns.
+
+    A filepath is accepted if it matches any include pattern (or there are
+     none) and no exclude pattern. Matching ignores case, the path
+     separator and a trailing .dcx, so that /param/** selects
+     /param/GameParam/GameParam.parambnd.dcx.
+
+    Files unpacked from inside an accepted container (a *bnd, or a BDT/BHD
+     pair) are passed with inherited=True, and are then only checked
+     against the exclude patterns.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [glob_to_regex(pattern) for pattern in (include or [])]
+        self.exclude = [glob_to_regex(pattern) for pattern in (exclude or [])]
+
+    def accepts(self, path, inherited=False):
+        """Checks if path is selected by this filter."""
+
+        candidates = [normalize_path(path)]
+        if candidates[0].endswith(".dcx"):
+            candidates.append(candidates[0][:-4])
+
+        for regex in self.exclude:
+            if any(regex.match(candidate) for candidate in candidates):
+                return False
+        if inherited or len(self.include) == 0:
+            return True
+        for regex in self.include:
+            if any(regex.match(candidate) for candidate in candidates):
+                return True
+        return False
+
+    def inherited(self, prefix=""):
+        """Returns a predicate that checks filepaths inside an accepted
+         container, after joining them to prefix.
+        """
+
+        return lambda path: self.accepts(prefix + "/" + normalize_path(path).lstrip("/"), inherited=True)
@@ -0,0 +1,70 @@
+"""Builders for the small archives that the tests unpack, and a helper
+ to read back what was unpacked.
+"""
+
+import os
+import struct
+import zlib
+
+BINDER_VERSION = "07D7R6\x00\x00"
+BDF3_HEADER = "BDF3" + BINDER_VERSION + "\x00" * 4
+
+def make_dcx(content):
+    """Compresses content into a .dcx file."""
+
+    compressed = zlib.compress(content, 9)
+    return ("DCX\x00" + struct.pack(">IIIII", 0x10000, 0x18, 0x24, 0x24, 0x2c) + "DCS\x00" +
+     struct.pack(">II", len(content), len(compressed)) + "DCP\x00DFLT" + "\x00" * 0x18 + "DCA\x00" +
+     struct.pack(">I", 8) + compressed)
+
+def make_binder_records(files, names_offset, data_offsets):
+    """Returns the 0x74 record table and name table for files, a list of
+     tuples (filepath, content) stored at data_offsets.
+    """
+
+    records = ""
+    names = ""
+    for (i, ((filepath, content), data_offset)) in enumerate(zip(files, data_offsets)):
+        records += struct.pack("<IIIIII", 0x40, len(content), data_offset, i, names_offset + len(names),
+         len(content))
+        names += filepath + "\x00"
+    return records + names
+
+def make_bnd3(files):
+    """Returns a BND3 file holding files, a list of tuples (filepath, content)."""
+
+    names_offset = 0x20 + 24 * len(files)
+    data_offset = names_offset + sum(len(filepath) + 1 for (filepath, _) in files)
+    data_offsets = []
+    for (_, content) in files:
+        data_offsets.append(data_offset)
+        data_offset += len(content)
+    header = "BND3" + BINDER_VERSION + struct.pack("<III", 0x74, len(files), data_offsets[0]) + "\x00" * 8
+    return (header + make_binder_records(files, names_offset, data_offsets) +
+     "".join(content for (_, content) in files))
+
+def make_pair(files):
+    """Returns a tuple (header, data) of the BHF3 header and BDF3 data
+     files of a pair holding files, a list of tuples (filepath, content).
+    """
+
+    data = BDF3_HEADER
+    data_offsets = []
+    for (_, content) in files:
+        data_offsets.append(len(data))
+        data += content
+    header = "BHF3" + BINDER_VERSION + struct.pack("<II", 0x74, len(files)) + "\x00" * 12
+    return (header + make_binder_records(files, 0x20 + 24 * len(files), data_offsets), data)
+
+def read_tree(path):
+    """Returns a dictionary of the content of each file under path, by its
+     path relative to path with / separators.
+    """
+
+    tree = {}
+    for (directory, _, filenames) in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(directory, filename)
+            with open(filepath, 'rb') as f:
+                tree[os.path.relpath(filepath, path).replace(os.sep, "/")] = f.read()
+    return tree
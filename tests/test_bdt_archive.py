@@ -0,0 +1,79 @@
+"""Tests for bdt_unpacker.BdtArchive, on a small generated BDT/BHD pair.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_builders
+import bdt_unpacker
+
+class BdtArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.texture = "".join(chr(i % 251) for i in xrange(3000))
+        (header, data) = archive_builders.make_pair([
+            ("\\chr\\c0000.tpf.dcx", archive_builders.make_dcx(self.texture)),
+            ("\\chr\\C0000_N.tpf", "N" * 700),
+            ("\\map\\m10.flver", "F" * 50),
+        ])
+        self.header = os.path.join(self.directory, "a.chrtpfbhd")
+        self.data = os.path.join(self.directory, "a.chrtpfbdt")
+        with open(self.header, 'wb') as f:
+            f.write(header)
+        with open(self.data, 'wb') as f:
+            f.write(data)
+        self.archive = bdt_unpacker.BdtArchive(self.header, self.data)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.directory)
+
+    def test_list(self):
+        self.assertEqual(self.archive.list(), ["/chr/C0000_N.tpf", "/chr/c0000.tpf.dcx", "/map/m10.flver"])
+
+    def test_stat(self):
+        (offset, length) = self.archive.stat("/map/m10.flver")
+        self.assertEqual(length, 50)
+        with open(self.data, 'rb') as f:
+            f.seek(offset)
+            self.assertEqual(f.read(length), "F" * 50)
+
+    def test_stat_folds_case_and_separators(self):
+        self.assertEqual(self.archive.stat("\\MAP\\M10.FLVER"), self.archive.stat("/map/m10.flver"))
+        self.assertEqual(self.archive.stat("/chr/c0000_n.tpf"), self.archive.stat("/chr/C0000_N.tpf"))
+
+    def test_missing_file(self):
+        self.assertRaises(KeyError, self.archive.stat, "/map/m11.flver")
+        self.assertRaises(KeyError, self.archive.read, "/map/m10.flver/x")
+
+    def test_read_decompresses(self):
+        self.assertEqual(self.archive.read("/chr/c0000.tpf.dcx"), self.texture)
+
+    def test_read_raw(self):
+        raw = self.archive.read("/chr/c0000.tpf.dcx", decompress=False)
+        self.assertEqual(raw, archive_builders.make_dcx(self.texture))
+        self.assertEqual(type(raw), str)
+
+    def test_read_view(self):
+        view = self.archive.read("/CHR/C0000_N.TPF", copy=False)
+        self.assertNotEqual(type(view), str)
+        self.assertEqual(len(view), 700)
+        self.assertEqual(view[:], "N" * 700)
+        # Compressed files are still decompressed into a new string.
+        self.assertEqual(self.archive.read("/chr/c0000.tpf.dcx", copy=False), self.texture)
+
+    def test_bad_data_file(self):
+        with open(self.data, 'r+b') as f:
+            f.write("XXXX")
+        self.assertRaises(ValueError, bdt_unpacker.BdtArchive, self.header, self.data)
+
+if __name__ == "__main__":
+    unittest.main()
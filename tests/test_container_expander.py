@@ -0,0 +1,144 @@
+"""Tests for container_expander.ContainerExpander, on small generated
+ archives.
+
+Usage: python -m unittest discover tests
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_builders
+import container_expander
+import dcx_uncompresser
+import output_files
+
+ROUTES = [
+    ("BDF3", "**/*.tpfbdt", "tx"),
+    ("BND3", "**", os.path.join("bnd", "{directory}")),
+]
+
+class ContainerExpanderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def expand(self, filepath, content, write_bnd_files=True, workers=None, selection=None):
+        """Expands content, the file filepath at depth 1, and every container
+         in it. Returns the ContainerExpander.
+        """
+
+        pool = multiprocessing.Pool(workers) if workers is not None else None
+        output_dirs = output_files.OutputDirectories()
+        writer = output_files.WriteBehindQueue(output_dirs)
+        decompressor = dcx_uncompresser.DecompressionPool(1)
+        try:
+            expander = container_expander.ContainerExpander(ROUTES, self.root_dir,
+             os.path.join(self.root_dir, "n"), selection=selection, write_bnd_files=write_bnd_files,
+             output_dirs=output_dirs, writer=writer, pool=pool)
+            expander.expand(os.path.join(self.root_dir, filepath), content, 1)
+            expander.collect()
+            expander.expand_pairs(decompressor)
+            writer.close()
+        finally:
+            decompressor.close()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return expander
+
+    def check_pair_in_bnd(self, wrap_data, write_bnd_files, workers):
+        (header, data) = archive_builders.make_pair([("\\t0.tpf", "T0" * 50), ("\\t1.tpf", "T1" * 70)])
+        if wrap_data:
+            data_member = ("m\\a.tpfbdt.dcx", archive_builders.make_dcx(data))
+        else:
+            data_member = ("m\\a.tpfbdt", data)
+        bnd = archive_builders.make_bnd3([("m\\a.tpfbhd", header), data_member, ("m\\b.txt", "B" * 30)])
+        expander = self.expand("c.chrbnd", bnd, write_bnd_files, workers)
+
+        tree = archive_builders.read_tree(self.root_dir)
+        self.assertEqual(tree["tx/t0.tpf"], "T0" * 50)
+        self.assertEqual(tree["tx/t1.tpf"], "T1" * 70)
+        self.assertEqual([os.path.relpath(filepath, self.root_dir).replace(os.sep, "/")
+         for filepath in expander.expansions[os.path.join(self.root_dir, "c.chrbnd")]],
+         ["bnd/m/a.tpfbhd", "bnd/" + data_member[0].replace("\\", "/"), "bnd/m/b.txt"])
+        self.assertEqual("bnd/m/b.txt" in tree, write_bnd_files)
+        # The data file is removed once unpacked, but a .dcx holding it is kept with the others.
+        self.assertNotIn("bnd/m/a.tpfbdt", tree)
+        self.assertEqual("bnd/m/a.tpfbdt.dcx" in tree, wrap_data and write_bnd_files)
+
+    def test_pair_in_bnd(self):
+        self.check_pair_in_bnd(False, True, None)
+
+    def test_pair_in_bnd_not_written(self):
+        self.check_pair_in_bnd(False, False, None)
+
+    def test_pair_in_bnd_not_written_on_pool(self):
+        self.check_pair_in_bnd(False, False, 2)
+
+    def test_compressed_pair_in_bnd(self):
+        self.check_pair_in_bnd(True, True, None)
+
+    def test_compressed_pair_in_bnd_not_written(self):
+        self.check_pair_in_bnd(True, False, None)
+
+    def test_compressed_pair_in_bnd_not_written_on_pool(self):
+        self.check_pair_in_bnd(True, False, 2)
+
+    def test_compressed_file_is_only_inflated_for_containers(self):
+        inflated = []
+        uncompress_dcx_content = dcx_uncompresser.uncompress_dcx_content
+        def record_uncompress(content):
+            inflated.append(len(content))
+            return uncompress_dcx_content(content)
+        dcx_uncompresser.uncompress_dcx_content = record_uncompress
+        try:
+            inner = archive_builders.make_bnd3([("m\\inner.txt", "I" * 20)])
+            bnd = archive_builders.make_bnd3([("m\\a.txt.dcx", archive_builders.make_dcx("A" * 4000)),
+             ("m\\inner.bnd.dcx", archive_builders.make_dcx(inner))])
+            expander = self.expand("c.chrbnd", bnd)
+        finally:
+            dcx_uncompresser.uncompress_dcx_content = uncompress_dcx_content
+
+        self.assertEqual(len(inflated), 1)
+        tree = archive_builders.read_tree(self.root_dir)
+        self.assertEqual(tree["bnd/bnd/m/m/inner.txt"], "I" * 20)
+        self.assertEqual(tree["bnd/m/a.txt.dcx"], archive_builders.make_dcx("A" * 4000))
+        self.assertIn(os.path.join(self.root_dir, "bnd", "m", "inner.bnd"), expander.expansions)
+
+    def test_peek_dcx_content(self):
+        content = "".join(chr(i % 251) for i in xrange(50000))
+        dcx = archive_builders.make_dcx(content)
+        self.assertEqual(dcx_uncompresser.peek_dcx_content(dcx, 4), content[:4])
+        self.assertEqual(dcx_uncompresser.peek_dcx_content(buffer(dcx), 3000), content[:3000])
+        self.assertEqual(dcx_uncompresser.peek_dcx_content(archive_builders.make_dcx("ab"), 4), "ab")
+
+    def test_header_without_data_is_written(self):
+        (header, _) = archive_builders.make_pair([("\\t0.tpf", "T0" * 50)])
+        bnd = archive_builders.make_bnd3([("m\\a.tpfbhd", header), ("m\\b.txt", "B" * 30)])
+        self.expand("c.chrbnd", bnd, write_bnd_files=False)
+
+        tree = archive_builders.read_tree(self.root_dir)
+        self.assertEqual(tree, {"bnd/m/a.tpfbhd": header})
+
+    def test_worker_failure_keeps_traceback(self):
+        bnd = archive_builders.make_bnd3([("m\\b.txt", "B" * 30)])
+        # Break the separator of the first record.
+        bnd = bnd[:0x20] + "\x41" + bnd[0x21:]
+        with self.assertRaises(RuntimeError) as raised:
+            self.expand("c.chrbnd", bnd, workers=2)
+        message = str(raised.exception)
+        self.assertIn("c.chrbnd failed in a worker process", message)
+        self.assertIn("Traceback", message)
+        self.assertIn("ValueError: Expected separator 0x40", message)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+"""Tests for dcx_uncompresser's streaming decompression and DecompressionPool.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import random
+import StringIO
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_builders
+import dcx_uncompresser
+
+class UncompressDcxStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        # Random-looking bytes barely compress, so the compressed data
+        #  spans several chunks as well.
+        generator = random.Random(0)
+        self.content = "".join(chr(generator.randrange(256)) for _ in xrange(20000)) + "Z" * 30000
+        self.dcx = archive_builders.make_dcx(self.content)
+
+    def uncompress(self, dcx, chunk_size, prefix=""):
+        src = StringIO.StringIO(prefix + dcx)
+        src.seek(len(prefix))
+        dst = StringIO.StringIO()
+        written = dcx_uncompresser.uncompress_dcx_stream(src, dst, chunk_size)
+        self.assertEqual(written, len(dst.getvalue()))
+        return dst.getvalue()
+
+    def test_matches_uncompress_dcx_content(self):
+        self.assertEqual(self.uncompress(self.dcx, dcx_uncompresser.DCX_STREAM_CHUNK_SIZE), self.content)
+        self.assertEqual(dcx_uncompresser.uncompress_dcx_content(self.dcx), self.content)
+
+    def test_chunk_boundaries(self):
+        for chunk_size in [1, 2, 3, 7, 64, 4095, 4096, 4097, len(self.dcx)]:
+            self.assertEqual(self.uncompress(self.dcx, chunk_size), self.content, "chunk_size " + str(chunk_size))
+
+    def test_output_is_limited_to_chunk_size(self):
+        pieces = []
+        class Recorder(object):
+            def write(self, piece):
+                pieces.append(piece)
+        src = StringIO.StringIO(archive_builders.make_dcx("A" * 100000))
+        self.assertEqual(dcx_uncompresser.uncompress_dcx_stream(src, Recorder(), 1000), 100000)
+        self.assertEqual("".join(pieces), "A" * 100000)
+        self.assertTrue(max(len(piece) for piece in pieces) <= 1000)
+
+    def test_reads_from_current_position(self):
+        self.assertEqual(self.uncompress(self.dcx, 1000, prefix="BDF3" * 10), self.content)
+
+    def test_stops_at_end_of_compressed_data(self):
+        src = StringIO.StringIO(self.dcx + "next record")
+        dcx_uncompresser.uncompress_dcx_stream(src, StringIO.StringIO(), 1000)
+        self.assertEqual(src.read(), "next record")
+
+    def test_empty_content(self):
+        self.assertEqual(self.uncompress(archive_builders.make_dcx(""), 16), "")
+
+    def test_truncated_header(self):
+        for size in [0, 4, dcx_uncompresser.DCX_HEADER_SIZE - 1]:
+            with self.assertRaises(ValueError) as raised:
+                self.uncompress(self.dcx[:size], 1000)
+            self.assertEqual(str(raised.exception), "DCX header is truncated.")
+
+    def test_truncated_data(self):
+        # Cutting off only the zlib checksum at the end loses no data, so
+        #  the cuts leave some of the deflate stream out.
+        for size in [dcx_uncompresser.DCX_HEADER_SIZE, dcx_uncompresser.DCX_HEADER_SIZE + 10, len(self.dcx) // 2,
+         len(self.dcx) - 16]:
+            for chunk_size in [7, 1000, len(self.dcx)]:
+                with self.assertRaises(ValueError) as raised:
+                    self.uncompress(self.dcx[:size], chunk_size)
+                self.assertEqual(str(raised.exception), "DCX compressed data is truncated.")
+
+    def test_bad_header(self):
+        self.assertRaises(ValueError, self.uncompress, "XCD\x00" + self.dcx[4:], 1000)
+
+class DecompressionPoolTest(unittest.TestCase):
+
+    def check_failure(self, ordered, processes):
+        good = archive_builders.make_dcx("G" * 1000)
+        # Break the deflate stream just after its header.
+        bad = archive_builders.make_dcx("B" * 1000)
+        bad = bad[:dcx_uncompresser.DCX_HEADER_SIZE] + "\xff" * 8 + bad[dcx_uncompresser.DCX_HEADER_SIZE + 8:]
+        items = [("a.dcx", good), ("plain.txt", "P" * 10), ("broken.dcx", bad), ("b.dcx", good)]
+        pool = dcx_uncompresser.DecompressionPool(2, processes)
+        try:
+            with self.assertRaises(RuntimeError) as raised:
+                list(pool.uncompress_all(items, ordered))
+        finally:
+            pool.close()
+        message = str(raised.exception)
+        self.assertTrue(message.startswith("Decompressing broken.dcx failed in a worker:\n"), message)
+        self.assertIn("Traceback", message)
+        self.assertIn("error: Error -3 while decompressing", message)
+
+    def test_failure_ordered(self):
+        self.check_failure(True, False)
+
+    def test_failure_unordered(self):
+        self.check_failure(False, False)
+
+    def test_failure_in_process(self):
+        self.check_failure(True, True)
+
+    def test_results(self):
+        items = [("a.dcx", archive_builders.make_dcx("A" * 1000)), ("plain.txt", "P" * 10), ("none", None)]
+        pool = dcx_uncompresser.DecompressionPool(2)
+        try:
+            self.assertEqual(list(pool.uncompress_all(items)),
+             [("a.dcx", "A" * 1000, True), ("plain.txt", "P" * 10, False), ("none", None, False)])
+            self.assertEqual(sorted(pool.uncompress_all(items, ordered=False)),
+             [("a.dcx", "A" * 1000, True), ("none", None, False), ("plain.txt", "P" * 10, False)])
+        finally:
+            pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+"""Tests for memory_budget.MemoryBudget: that producers wait for the budget,
+ but never for bytes that can no longer be freed.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_builders
+import bdt_unpacker
+import dcx_uncompresser
+import memory_budget
+import output_files
+
+# How long a test waits for a thread that should finish, and how long it
+#  watches one that should stay blocked, in seconds.
+FINISH_TIMEOUT = 5.0
+BLOCKED_DELAY = 0.2
+
+class Producer(object):
+    """Runs acquire and release calls on a thread of its own, as a producer
+     stage of an unpack does, so that each holds bytes under its own thread.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._calls = Queue.Queue()
+        self._finished = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start(self, method, size):
+        """Starts calling budget.method(size) on the producer's thread."""
+
+        self._calls.put((method, size))
+
+    def wait(self, timeout=FINISH_TIMEOUT):
+        """Waits for the last call started to return. Returns False if it
+         is still blocked after timeout seconds.
+        """
+
+        try:
+            self._finished.get(timeout=timeout)
+        except Queue.Empty:
+            return False
+        return True
+
+    def call(self, method, size):
+        """Calls budget.method(size) on the producer's thread, and waits for it."""
+
+        self.start(method, size)
+        if not self.wait():
+            raise AssertionError(method + "(" + str(size) + ") did not return.")
+
+    def stop(self):
+        self._calls.put(None)
+        self._thread.join(FINISH_TIMEOUT)
+
+    def _run(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            (method, size) = call
+            getattr(self.budget, method)(size)
+            self._finished.put(call)
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.producers = []
+
+    def tearDown(self):
+        for producer in self.producers:
+            producer.stop()
+
+    def make_producer(self, budget):
+        producer = Producer(budget)
+        self.producers.append(producer)
+        return producer
+
+    def test_acquire_within_limit(self):
+        budget = memory_budget.MemoryBudget(100)
+        producer = self.make_producer(budget)
+        producer.call("acquire", 60)
+        producer.call("acquire", 40)
+        self.assertEqual(budget.used, 100)
+        producer.call("release", 100)
+        self.assertEqual(budget.used, 0)
+        self.assertEqual(budget.peak, 100)
+
+    def test_no_limit_never_waits(self):
+        budget = memory_budget.MemoryBudget(None)
+        producer = self.make_producer(budget)
+        producer.call("acquire", 10 ** 12)
+        self.assertEqual(budget.used, 10 ** 12)
+
+    def test_acquire_waits_for_release(self):
+        budget = memory_budget.MemoryBudget(100)
+        first = self.make_producer(budget)
+        second = self.make_producer(budget)
+        first.call("acquire", 80)
+        second.start("acquire", 40)
+        self.assertFalse(second.wait(BLOCKED_DELAY))
+        first.call("release", 80)
+        self.assertTrue(second.wait())
+        self.assertEqual(budget.used, 40)
+
+    def test_producers_holding_the_whole_budget_do_not_deadlock(self):
+        budget = memory_budget.MemoryBudget(100)
+        first = self.make_producer(budget)
+        second = self.make_producer(budget)
+        first.call("acquire", 60)
+        second.call("acquire", 30)
+
+        # The first waits for bytes that the second still holds...
+        first.start("acquire", 30)
+        self.assertFalse(first.wait(BLOCKED_DELAY))
+        # ...until the second waits as well. Nothing held can then be
+        #  released, so one of them must be let through over the limit.
+        second.start("acquire", 30)
+        finished = [producer for producer in [first, second] if producer.wait(BLOCKED_DELAY * 5)]
+        self.assertEqual(len(finished), 1)
+        self.assertEqual(budget.used, 120)
+
+        # Once it releases, the other fits and continues.
+        finished[0].call("release", 90 if finished[0] is first else 60)
+        other = second if finished[0] is first else first
+        self.assertTrue(other.wait())
+        self.assertTrue(budget.used <= 100)
+
+    def test_oversized_request_alone_is_allowed(self):
+        budget = memory_budget.MemoryBudget(100)
+        producer = self.make_producer(budget)
+        producer.call("acquire", 500)
+        self.assertEqual(budget.used, 500)
+        self.assertEqual(budget.peak, 500)
+
+    def test_oversized_request_waits_for_others_to_release(self):
+        budget = memory_budget.MemoryBudget(100)
+        holder = self.make_producer(budget)
+        producer = self.make_producer(budget)
+        holder.call("acquire", 50)
+        producer.start("acquire", 500)
+        self.assertFalse(producer.wait(BLOCKED_DELAY))
+        holder.call("release", 50)
+        self.assertTrue(producer.wait())
+        self.assertEqual(budget.used, 500)
+
+    def test_charge_never_waits(self):
+        budget = memory_budget.MemoryBudget(100)
+        producer = self.make_producer(budget)
+        producer.call("acquire", 100)
+        budget.charge(200)
+        self.assertEqual(budget.used, 300)
+        budget.discharge(200)
+        self.assertEqual(budget.used, 100)
+
+    def test_discharge_wakes_waiting_producer(self):
+        budget = memory_budget.MemoryBudget(100)
+        producer = self.make_producer(budget)
+        producer.call("acquire", 10)
+        producer.call("release", 10)
+        # The writer holds bytes that the producer handed on.
+        budget.charge(90)
+        producer.start("acquire", 20)
+        self.assertFalse(producer.wait(BLOCKED_DELAY))
+        budget.discharge(90)
+        self.assertTrue(producer.wait())
+        self.assertEqual(budget.used, 20)
+
+    def test_charged_bytes_are_not_counted_as_waiting(self):
+        budget = memory_budget.MemoryBudget(100)
+        producer = self.make_producer(budget)
+        producer.call("acquire", 30)
+        budget.charge(70)
+        # Only the producer's own 30 bytes are stuck while it waits, so
+        #  it must keep waiting for the charged bytes to be discharged.
+        producer.start("acquire", 10)
+        self.assertFalse(producer.wait(BLOCKED_DELAY))
+        budget.discharge(70)
+        self.assertTrue(producer.wait())
+        self.assertEqual(budget.used, 40)
+
+    def test_failed_unpack_releases_what_it_holds(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # Break the deflate stream of the second file just after its header.
+        broken = archive_builders.make_dcx("B" * 1000)
+        broken = (broken[:dcx_uncompresser.DCX_HEADER_SIZE] + "\xff" * 8 +
+         broken[dcx_uncompresser.DCX_HEADER_SIZE + 8:])
+        (header, data) = archive_builders.make_pair([("\\a.txt", "A" * 100), ("\\b.txt.dcx", broken)])
+        header_file = os.path.join(directory, "a.tpfbhd")
+        data_file = os.path.join(directory, "a.tpfbdt")
+        with open(header_file, 'wb') as f:
+            f.write(header)
+        with open(data_file, 'wb') as f:
+            f.write(data)
+
+        budget = memory_budget.MemoryBudget(1)
+        writer = output_files.WriteBehindQueue(output_files.OutputDirectories(), budget=budget)
+        try:
+            # The unpack fails while it still holds the broken file's bytes.
+            self.assertRaises(RuntimeError, bdt_unpacker.unpack_archive, header_file, data_file,
+             os.path.join(directory, "out"), progress=lambda count, total: None, writer=writer)
+        finally:
+            writer.close()
+        self.assertEqual(budget.used, 0)
+        # So the next producer is not kept waiting for them.
+        self.make_producer(budget).call("acquire", 10)
+
+if __name__ == "__main__":
+    unittest.main()
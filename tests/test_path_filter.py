@@ -0,0 +1,107 @@
+"""Tests for path_filter's glob patterns and PathFilter.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import path_filter
+
+class GlobToRegexTest(unittest.TestCase):
+
+    def matches(self, pattern, path):
+        return path_filter.glob_to_regex(pattern).match(path_filter.normalize_path(path)) is not None
+
+    def test_normalize_path(self):
+        self.assertEqual(path_filter.normalize_path("N:\\FRPG\\Data\\a.bin"), "/frpg/data/a.bin")
+        self.assertEqual(path_filter.normalize_path("param/a.bin"), "/param/a.bin")
+        self.assertEqual(path_filter.normalize_path("/param/a.bin"), "/param/a.bin")
+
+    def test_star_stays_in_one_component(self):
+        self.assertTrue(self.matches("/chr/*.chrbnd", "/chr/c0000.chrbnd"))
+        self.assertFalse(self.matches("/chr/*.chrbnd", "/chr/sub/c0000.chrbnd"))
+        self.assertTrue(self.matches("/chr/c000?.chrbnd", "/chr/c0001.chrbnd"))
+        self.assertFalse(self.matches("/chr/c000?.chrbnd", "/chr/c00011.chrbnd"))
+        self.assertFalse(self.matches("/c?r/a", "/c/r/a"))
+
+    def test_double_star(self):
+        self.assertTrue(self.matches("/map/**", "/map/m10/a/b.flver"))
+        self.assertTrue(self.matches("/**/*.tpf", "/map/tx/a.tpf"))
+        self.assertFalse(self.matches("/map/**.tpf", "/chr/a.tpf"))
+
+    def test_double_star_slash_matches_no_directories(self):
+        self.assertTrue(self.matches("/map/**/a.tpf", "/map/a.tpf"))
+        self.assertTrue(self.matches("/map/**/a.tpf", "/map/x/y/a.tpf"))
+        self.assertFalse(self.matches("/map/**/a.tpf", "/map/xa.tpf"))
+        self.assertTrue(self.matches("**/*.hkxbdt", "/map/m10/h.hkxbdt"))
+
+    def test_trailing_slash_matches_everything_beneath(self):
+        self.assertTrue(self.matches("/param/", "/param/GameParam/a.param"))
+        self.assertFalse(self.matches("/param/", "/paramdef/a.paramdef"))
+
+    def test_matching_is_whole_path(self):
+        self.assertFalse(self.matches("/chr/a.tpf", "/chr/a.tpf.bak"))
+        self.assertFalse(self.matches("a.tpf", "/chr/a.tpf"))
+
+    def test_case_separators_and_special_characters(self):
+        self.assertTrue(self.matches("\\CHR\\C0000.chrbnd", "/chr/c0000.CHRBND"))
+        self.assertTrue(self.matches("/a+b(1).txt", "/A+B(1).txt"))
+        self.assertFalse(self.matches("/a.txt", "/abtxt"))
+
+    def test_n_prefix(self):
+        self.assertTrue(self.matches("/frpg/data/**", "N:\\FRPG\\data\\a.bin"))
+        self.assertTrue(self.matches("N:/FRPG/**", "/frpg/a.bin"))
+
+class PathFilterTest(unittest.TestCase):
+
+    def test_no_patterns_accepts_everything(self):
+        self.assertTrue(path_filter.PathFilter().accepts("/anything/at/all"))
+
+    def test_include_and_exclude(self):
+        selection = path_filter.PathFilter(["/param/**", "/msg/**"], ["**/*.fmg"])
+        self.assertTrue(selection.accepts("/param/GameParam/a.param"))
+        self.assertTrue(selection.accepts("/msg/ENGLISH/item.msgbnd"))
+        self.assertFalse(selection.accepts("/msg/ENGLISH/a.fmg"))
+        self.assertFalse(selection.accepts("/chr/c0000.chrbnd"))
+
+    def test_exclude_only(self):
+        selection = path_filter.PathFilter(exclude=["/sound/"])
+        self.assertTrue(selection.accepts("/chr/c0000.chrbnd"))
+        self.assertFalse(selection.accepts("/sound/frpg_xm18.fsb"))
+
+    def test_dcx_is_stripped(self):
+        selection = path_filter.PathFilter(["/param/**/*.parambnd"], ["/chr/*.chrbnd"])
+        self.assertTrue(selection.accepts("/param/GameParam/GameParam.parambnd.dcx"))
+        self.assertFalse(selection.accepts("/chr/c0000.chrbnd.dcx"))
+        # The pattern may also name the .dcx itself.
+        self.assertTrue(path_filter.PathFilter(["/chr/*.dcx"]).accepts("/chr/c0000.chrbnd.dcx"))
+
+    def test_n_prefix(self):
+        selection = path_filter.PathFilter(["/frpg/data/interroot_win32/chr/**"])
+        self.assertTrue(selection.accepts("N:\\FRPG\\data\\INTERROOT_win32\\chr\\c0000\\c0000.flver"))
+        self.assertFalse(selection.accepts("N:\\FRPG\\data\\INTERROOT_win32\\map\\m10.flver"))
+
+    def test_inherited_only_checks_exclude(self):
+        selection = path_filter.PathFilter(["/chr/**"], ["**/*.hkx"])
+        self.assertFalse(selection.accepts("/map/a.tpf"))
+        self.assertTrue(selection.accepts("/map/a.tpf", inherited=True))
+        self.assertFalse(selection.accepts("/map/a.hkx", inherited=True))
+
+    def test_inherited_predicate_joins_prefix(self):
+        selection = path_filter.PathFilter(["/chr/**"], ["/map/tx/**", "**/*.hkx"])
+        accepts = selection.inherited("map/tx")
+        self.assertFalse(accepts("\\m10\\a.tpf"))
+        accepts = selection.inherited("chr")
+        self.assertTrue(accepts("\\c0000\\a.tpf"))
+        self.assertTrue(accepts("N:\\c0000\\a.tpf"))
+        self.assertFalse(accepts("c0000/a.hkx.dcx"))
+        # Without a prefix, paths are checked as they are.
+        self.assertTrue(selection.inherited()("/map/a.tpf"))
+        self.assertFalse(selection.inherited()("/map/tx/a.tpf"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests for bdt_unpacker.plan_sequential_reads.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bdt_unpacker
+
+def plan(records, max_gap=16, max_run_size=100, stream_min_size=50):
+    """Plans reads for records, a list of tuples (name, offset, size),
+     with small limits so that runs are easy to follow.
+    """
+
+    file_dict = dict((name, (offset, size)) for (name, offset, size) in records)
+    return bdt_unpacker.plan_sequential_reads(file_dict, max_gap, max_run_size, stream_min_size)
+
+class PlanSequentialReadsTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(plan([]), [])
+
+    def test_adjacent_records_are_merged_in_offset_order(self):
+        self.assertEqual(plan([("b", 10, 10), ("a", 0, 10), ("c", 20, 5)]),
+         [(0, 25, [("a", 0, 10), ("b", 10, 10), ("c", 20, 5)])])
+
+    def test_gap(self):
+        # A gap of exactly max_gap is read through; a larger one is not.
+        self.assertEqual(plan([("a", 0, 10), ("b", 26, 10)]),
+         [(0, 36, [("a", 0, 10), ("b", 26, 10)])])
+        self.assertEqual(plan([("a", 0, 10), ("b", 27, 10)]),
+         [(0, 10, [("a", 0, 10)]), (27, 10, [("b", 27, 10)])])
+
+    def test_run_size(self):
+        records = [("a", 0, 40), ("b", 40, 40), ("c", 80, 20), ("d", 100, 1)]
+        self.assertEqual(plan(records),
+         [(0, 100, [("a", 0, 40), ("b", 40, 40), ("c", 80, 20)]), (100, 1, [("d", 100, 1)])])
+        # The gap counts towards the run's size.
+        self.assertEqual(plan([("a", 0, 40), ("b", 56, 40), ("c", 96, 10)]),
+         [(0, 96, [("a", 0, 40), ("b", 56, 40)]), (96, 10, [("c", 96, 10)])])
+
+    def test_overlapping_records(self):
+        records = [("a", 0, 30), ("b", 10, 10), ("c", 10, 5), ("d", 25, 15)]
+        self.assertEqual(plan(records),
+         [(0, 40, [("a", 0, 30), ("c", 10, 5), ("b", 10, 10), ("d", 25, 15)])])
+
+    def test_shared_data_is_listed_for_each_name(self):
+        self.assertEqual(plan([("b", 0, 10), ("a", 0, 10)]),
+         [(0, 10, [("a", 0, 10), ("b", 0, 10)])])
+
+    def test_large_records_get_their_own_run(self):
+        records = [("a", 0, 10), ("big", 10, 50), ("b", 60, 10), ("c", 70, 10)]
+        self.assertEqual(plan(records, max_run_size=1000),
+         [(0, 10, [("a", 0, 10)]), (10, 50, [("big", 10, 50)]), (60, 20, [("b", 60, 10), ("c", 70, 10)])])
+
+    def test_record_larger_than_run_size(self):
+        self.assertEqual(plan([("a", 0, 10), ("big", 10, 500)], stream_min_size=1000),
+         [(0, 10, [("a", 0, 10)]), (10, 500, [("big", 10, 500)])])
+
+    def test_default_limits(self):
+        mib = 1024 * 1024
+        records = [("a", 0, 1000), ("b", 1000 + 64 * 1024, 1000), ("c", 200 * 1024, 1000),
+         ("big", 300 * 1024, mib), ("d", 300 * 1024 + mib, 1000)]
+        file_dict = dict((name, (offset, size)) for (name, offset, size) in records)
+        self.assertEqual([[name for (name, _, _) in run_records] for (_, _, run_records)
+         in bdt_unpacker.plan_sequential_reads(file_dict)], [["a", "b"], ["c"], ["big"], ["d"]])
+
+if __name__ == "__main__":
+    unittest.main()
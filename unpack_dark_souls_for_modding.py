@@ -1,3 +1,4 @@
+import multiprocessing
 import logging
 import colorama
 log = logging.getLogger(__name__)
@@ -5,6 +6,7 @@ log = logging.getLogger(__name__)
 import unpacker_file_handler
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     LOG_FILE = "unpackDS-latestlog.txt"
     
     colorama.init()
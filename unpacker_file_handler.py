@@ -6,10 +6,17 @@ import shutil
 import hashlib
 import sys
 import mmap
+import multiprocessing
+import threading
 
 import bdt_unpacker
 import bnd_unpacker
 import c4110_replacement
+import container_expander
+import dcx_uncompresser
+import memory_budget
+import output_files
+import path_filter
 
 UNPACKED_DIRS = [
     "chr", "event", "facegen", "font", "map", "menu", "msg", "mtd", 
@@ -22,6 +29,21 @@ TEMP_FRPG_DIR = "unpackDS-BND"
 TEMP_FRPG_DATA_SUBDIR = "content-DATA"
 TEMP_FRPG_N_SUBDIR = "content-N"
 
+UNKNOWN_HASH_REPORT_FILE = "unpackDS-unknown-hashes.txt"
+
+# Where the files of the containers found while unpacking go (see
+#  container_expander.ContainerExpander). The files of BDT/BHD pairs are
+#  redirected depending on the extension, so that the .exe modifications 
+#  make sense. *bnd files that are themselves inside TEMP_FRPG_DIR are 
+#  unpacked next to where they are.
+CONTAINER_ROUTES = [
+    ("BDF3", "**/*.chrtpfbdt", "chr"),
+    ("BDF3", "**/*.hkxbdt", "map"),
+    ("BDF3", "**/*.tpfbdt", os.path.join("map", "tx")),
+    ("BND3", TEMP_FRPG_DIR + "/**", "{directory}"),
+    ("BND3", "**", os.path.join(TEMP_FRPG_DIR, TEMP_FRPG_DATA_SUBDIR, "{directory}")),
+]
+
 ANSI_BRIGHT_RED = "\x1b[31;1m"
 ANSI_BRIGHT_YELLOW = "\x1b[33;1m"
 ANSI_END = "\x1b[0m"
@@ -226,26 +248,106 @@ def modify_exe(filename):
         mm.close()
     return
     
-def build_bdt_bhd_pairing(file_list):
-    bdt_list = [f for f in file_list if os.path.splitext(f)[1][-3:] == "bdt"]
-    bhd_list = [f for f in file_list if os.path.splitext(f)[1][-3:] == "bhd"]
-    
-    return_dict = {bdt_file: [] for bdt_file in bdt_list}
-    for bdt_file in bdt_list:
-        (_, bdt_filename) = os.path.split(os.path.abspath(bdt_file))
-        trimmed_bdt_filename = bdt_filename[:-3]
-        for bhd_file in bhd_list:
-            (_, bhd_filename) = os.path.split(os.path.abspath(bhd_file))
-            trimmed_bhd_filename = bhd_filename[:-3]
-            if trimmed_bdt_filename == trimmed_bhd_filename:
-                return_dict[bdt_file].append(bhd_file)
-        log.info("bdt/bhd pairing dict entry for '" + str(bdt_file) + "':")
-        for f in return_dict[bdt_file]:
-            log.info(" " + str(f))
-    return return_dict
-            
-def unpack_archives():
-    """Uses bdt_unpacker to unpack the Dark Souls archive files. Prints progress."""
+def run_per_device(jobs, per_device_limit=1):
+    """Runs jobs on worker threads, with at most per_device_limit jobs
+     running at once for each block device.
+     
+    jobs is a list of tuples (filename, function). Each function is called
+     with no arguments, and counts against the device holding filename,
+     as found from st_dev. Where st_dev is not filled in (as on Windows),
+     every file counts as being on the same device.
+    Returns the results in the same order as jobs. Once a job raises an
+     exception, jobs that have not yet started are skipped; once the
+     running ones have finished, the first exception is re-raised.
+    """
+    
+    device_semaphores = {}
+    job_semaphores = []
+    for (filename, _) in jobs:
+        device = os.stat(filename).st_dev
+        if device not in device_semaphores:
+            device_semaphores[device] = threading.Semaphore(per_device_limit)
+        job_semaphores.append(device_semaphores[device])
+    log.info("Running " + str(len(jobs)) + " jobs on " + str(len(device_semaphores)) + " device(s).")
+    
+    results = [None] * len(jobs)
+    errors = [None] * len(jobs)
+    aborted = threading.Event()
+    def run_job(i):
+        with job_semaphores[i]:
+            if aborted.is_set():
+                return
+            try:
+                results[i] = jobs[i][1]()
+            except Exception:
+                errors[i] = sys.exc_info()
+                aborted.set()
+    
+    threads = [threading.Thread(target=run_job, args=(i,)) for i in xrange(len(jobs))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # Join with a timeout, so that Ctrl-C still reaches the main thread.
+        while t.is_alive():
+            t.join(0.1)
+    
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+def write_unknown_hash_report(unknown_records_by_archive):
+    """Writes UNKNOWN_HASH_REPORT_FILE, listing each archive record whose
+     name hash was unknown, and where it was unpacked to instead.
+     
+    unknown_records_by_archive is a list of tuples (data_file, unknown_records),
+     as filled in by bdt_unpacker.unpack_archive.
+    """
+    
+    with open(UNKNOWN_HASH_REPORT_FILE, 'w') as g:
+        g.write("# Archive records whose filepath hash is not in the name hash dictionary.\n")
+        g.write("# archive hash offset size unpacked-as\n")
+        for (data_file, unknown_records) in unknown_records_by_archive:
+            for (record_hash, record_offset, record_size) in unknown_records:
+                g.write(data_file + " " + ("0x%08x" % record_hash) + " " + str(record_offset) + " " + 
+                 str(record_size) + " " + bdt_unpacker.get_unknown_record_name(record_hash) + "\n")
+
+def unpack_archives(allow_unknown_hashes=True, include=None, exclude=None, archives_per_device=1,
+ write_workers=output_files.DEFAULT_WRITE_WORKERS, decompress_workers=None,
+ memory_limit=memory_budget.DEFAULT_MEMORY_LIMIT, keep_bnd_tree=True, bnd_workers=None,
+ max_depth=container_expander.DEFAULT_MAX_DEPTH):
+    """Uses bdt_unpacker to unpack the Dark Souls archive files. Prints progress.
+    
+    If allow_unknown_hashes is True, archive records whose name hash is
+     unknown are unpacked into bdt_unpacker.UNKNOWN_RECORD_DIR and listed
+     in UNKNOWN_HASH_REPORT_FILE, instead of aborting the unpack.
+     
+    include and exclude are optional lists of glob patterns for archive
+     filepaths, such as "/param/**" (see path_filter.PathFilter). Only
+     the selected records are read from the archives, and files nested
+     in *bnd files and BDT/BHD pairs are then only checked against exclude.
+     
+    The four archives are unpacked at the same time, with at most 
+     archives_per_device of them being read from any one disk at once.
+     Unpacked files are written by a pool of write_workers threads while
+     the next ones are read (see output_files.WriteBehindQueue), and
+     .dcx files are decompressed by a pool of decompress_workers threads
+     (by default, one per core).
+     
+    Reading pauses whenever file content held in memory would exceed
+     memory_limit bytes (or never, if it is None).
+     
+    The files inside *bnd files are unpacked into TEMP_FRPG_DIR only if
+     keep_bnd_tree is True. Either way, BND_MANIFEST_FILE lists them. The
+     *bnd files are unpacked by a pool of bnd_workers processes (by 
+     default, one per core), or directly if bnd_workers is 1.
+     
+    Containers are recognized by their magic bytes, and those nested inside
+     them are expanded too, for files up to max_depth deep (see 
+     container_expander.ContainerExpander). Where their files go is set by
+     CONTAINER_ROUTES.
+    """
     
     BND_MANIFEST_FILE = "bnd_manifest.txt"
     BND_MANIFEST_HEADER = "This manifest records the source *bnd file locations and their \n" + \
@@ -257,123 +359,146 @@ def unpack_archives():
      "modifying them has no effect, but can be useful for finding what \n" + \
      "file should be modified.\n\n\nMANIFEST:\n\n"
          
-    created_file_list = []
-    for i in [0, 1, 2, 3]:
-        header_file = "dvdbnd" + str(i) + ".bhd5"
-        data_file = "dvdbnd" + str(i) + ".bdt"
+    if include or exclude:
+        selection = path_filter.PathFilter(include, exclude)
+        log.info("Selecting files with include " + str(include) + ", exclude " + str(exclude))
+    else:
+        selection = None
+    
+    archives = [("dvdbnd" + str(i) + ".bhd5", "dvdbnd" + str(i) + ".bdt") for i in [0, 1, 2, 3]]
+    
+    # Start the worker processes before any threads, which they must not inherit.
+    if bnd_workers is None:
+        bnd_workers = multiprocessing.cpu_count()
+    bnd_pool = multiprocessing.Pool(bnd_workers) if bnd_workers > 1 else None
+    
+    try:
+        # Shared by every unpacking step, so each output directory is created once.
+        output_dirs = output_files.OutputDirectories()
+        budget = memory_budget.MemoryBudget(memory_limit)
+        writer = output_files.WriteBehindQueue(output_dirs, write_workers, budget=budget)
+        decompressor = dcx_uncompresser.DecompressionPool(decompress_workers)
         
-        print " - Unpacking archive " + str(data_file) + " using header " + str(header_file)
-        log.info("Unpack " + str(data_file) + " via " + str(header_file))
-        new_files = bdt_unpacker.unpack_archive(header_file, data_file, os.getcwd())
-        log.info(" Unpacking yielded " + str(len(new_files)) + " new files.")
-        created_file_list += new_files
+        # Containers are recognized as the archives produce them: *bnd files are
+        #  expanded from memory, and BDT/BHD pairs are held until both halves 
+        #  have been found, without writing either out.
+        expander = container_expander.ContainerExpander(CONTAINER_ROUTES, os.getcwd(), 
+         os.path.join(os.getcwd(), TEMP_FRPG_DIR, TEMP_FRPG_N_SUBDIR), max_depth, selection, 
+         keep_bnd_tree, output_dirs, writer, bnd_pool)
         
-    # Convert to set and back to remove duplicates.
-    created_file_list = list(set(created_file_list))
+        progress_lock = threading.Lock()
+        progress_counts = [(0, 0)] * len(archives)
+        def make_progress(i):
+            def progress(count, num_of_files):
+                with progress_lock:
+                    progress_counts[i] = (count, num_of_files)
+                    print "\r   - Unpacking files from archives (" + ", ".join(str(c) + "/" + str(n) 
+                     for (c, n) in progress_counts) + ")...",
+                    sys.stdout.flush()
+            return progress
         
-    print " - Unpacking BND archives."
-    bnd_list = [f for f in created_file_list if os.path.splitext(f)[1][-3:] == "bnd"]
-    log.info("Found " + str(len(bnd_list)) + " *bnd files.")
-    msg_len = 0
-    manifest_string_list = []
-    for count, filepath in enumerate(sorted(bnd_list)):
-        log.info("Unpack " + str(filepath))
-        (directory, filename) = os.path.split(os.path.abspath(filepath))
+        def make_job(i):
+            (header_file, data_file) = archives[i]
+            def job():
+                log.info("Unpack " + str(data_file) + " via " + str(header_file))
+                unknown_records = [] if allow_unknown_hashes else None
+                new_files = bdt_unpacker.unpack_archive(header_file, data_file, os.getcwd(), unknown_records,
+                 selection.accepts if selection is not None else None, make_progress(i), output_dirs, writer, 
+                 decompressor, payload_handler=expander.payload_handler(1), 
+                 record_handler=expander.record_handler(1), file_handler=expander.file_handler(1))
+                log.info(" Unpacking " + str(data_file) + " yielded " + str(len(new_files)) + " new files.")
+                return (new_files, unknown_records)
+            return (data_file, job)
         
-        rel_directory = os.path.relpath(directory)
+        print " - Unpacking archives " + ", ".join(data_file for (_, data_file) in archives) + "."
+        results = run_per_device([make_job(i) for i in xrange(len(archives))], archives_per_device)
+        writer.flush()
+        print "Done."
         
-        with open(filepath, 'rb') as f:
-            file_content = f.read()
-            new_file_list = bnd_unpacker.unpack_bnd(file_content, 
-             os.path.join(os.getcwd(), TEMP_FRPG_DIR, TEMP_FRPG_DATA_SUBDIR, rel_directory),
-             os.path.join(os.getcwd(), TEMP_FRPG_DIR, TEMP_FRPG_N_SUBDIR))
-            log.info(" Unpacking yielded " + str(len(new_file_list)) + " new files.")
-            created_file_list += new_file_list
-            
-            if len(new_file_list) > 0:
-                manifest_string_list.append(os.path.join(rel_directory, filename))
-                for new_file in new_file_list:
-                    new_file_rel = os.path.relpath(new_file, os.path.join(os.getcwd(), TEMP_FRPG_DIR))
-                    manifest_string_list.append(" " + new_file_rel)
+        # Merge in archive order, whatever order the archives finished in.
+        unknown_records_by_archive = []
+        for ((_, data_file), (new_files, unknown_records)) in zip(archives, results):
+            if unknown_records:
+                log.warning(" " + str(len(unknown_records)) + " records in " + str(data_file) + 
+                 " had unknown name hashes.")
+                unknown_records_by_archive.append((data_file, unknown_records))
         
+        if len(unknown_records_by_archive) > 0:
+            num_of_unknown = sum(len(unknown_records) for (_, unknown_records) in unknown_records_by_archive)
+            print (ANSI_BRIGHT_YELLOW + " - WARNING: " + ANSI_END + str(num_of_unknown) + 
+             " records had unknown names and were unpacked into \"" + bdt_unpacker.UNKNOWN_RECORD_DIR + 
+             "\".\n   See \"" + UNKNOWN_HASH_REPORT_FILE + "\" for the list.")
+            write_unknown_hash_report(unknown_records_by_archive)
         
-        print "\r" + " " * msg_len,
-        msg = "\r  - (" + str(count+1) + "/" + str(len(bnd_list)) + ") Unpacking BND file " + str(filename) + "..."
-        print msg,
-        msg_len = len(msg)
-        sys.stdout.flush()
-    print "Done."
-    
-    print " - Writing custom copy of missing file(s)...",
-    log.info("Write reconstructed file(s).")
-    manifest_string_list.append("-- Custom --")
-    filepath = c4110_replacement.PATH.replace('\\', '/')
-    filepath_to_use = bnd_unpacker.relativize_filename(filepath, 
-     os.getcwd(), os.path.join(os.getcwd(), TEMP_FRPG_DIR, TEMP_FRPG_N_SUBDIR))
-    f = bnd_unpacker.create_file(filepath_to_use)
-    f.write(c4110_replacement.DATA)
-    f.close()
-    created_file_list.append(filepath_to_use)
-    new_file_rel = os.path.relpath(filepath_to_use, os.path.join(os.getcwd(), TEMP_FRPG_DIR))
-    manifest_string_list.append(" " + new_file_rel)
-    print "Done."
+        print " - Unpacking BND archives."
+        msg_len = [0]
+        def bnd_progress(count, num_of_files, filepath):
+            print "\r" + " " * msg_len[0],
+            msg = "\r  - (" + str(count) + "/" + str(num_of_files) + ") Unpacking BND file " + \
+             os.path.basename(filepath) + "..."
+            print msg,
+            msg_len[0] = len(msg)
+            sys.stdout.flush()
+        expander.collect(bnd_progress)
+        writer.flush()
+        print "Done."
+        
+        print " - Adding custom copy of missing file(s)...",
+        log.info("Add reconstructed file(s).")
+        filepath = c4110_replacement.PATH.replace('\\', '/')
+        custom_filepath = bnd_unpacker.relativize_filename(filepath, 
+         os.getcwd(), os.path.join(os.getcwd(), TEMP_FRPG_DIR, TEMP_FRPG_N_SUBDIR))
+        # The file is a *bhd header, so it is only needed in memory.
+        expander.add_pair_header(custom_filepath, 1, c4110_replacement.DATA)
+        print "Done."
+        
+        log.info("Build bdt/bhd pairing.")
+        pairs_shown = [0]
+        def pair_progress(count, num_of_pairs, bdt_file, bhd_file):
+            if pairs_shown[0] > 0:
+                print "\r" + (ANSI_CURSOR_UP_LINE + ANSI_CLEAR_LINE)*4, # Erase the previous three lines.
+            pairs_shown[0] += 1
+            print "\r - (" + str(count) + "/" + str(num_of_pairs) + ") Unpacking BDT/BHD pairs... "
+            print "  - Unpacking archive " + os.path.basename(bdt_file) + " using header " + os.path.basename(bhd_file)
+        expander.expand_pairs(decompressor, pair_progress)
+        if pairs_shown[0] > 0:
+            print "\r" + (ANSI_CURSOR_UP_LINE + ANSI_CLEAR_LINE)*4, # Erase the previous three lines.
+        print "\r - (" + str(pairs_shown[0]) + "/" + str(pairs_shown[0]) + ") Unpacking BDT/BHD pairs... Done."
+    except:
+        # Stop the workers, rather than leave them unpacking the rest.
+        if bnd_pool is not None:
+            bnd_pool.terminate()
+            bnd_pool.join()
+        raise
+    if bnd_pool is not None:
+        bnd_pool.close()
+        bnd_pool.join()
     
     # Write out manifest, now that all *bnd-related files have been unpacked / created.
+    #  It lists the *bnd files in filepath order, however they were unpacked.
     log.info("Write manifest.")
-    with open(os.path.join(os.getcwd(), TEMP_FRPG_DIR, BND_MANIFEST_FILE), 'w') as g:
+    manifest_string_list = []
+    for filepath in sorted(expander.expansions.keys()):
+        new_file_list = expander.expansions[filepath]
+        if len(new_file_list) > 0:
+            manifest_string_list.append(os.path.relpath(os.path.abspath(filepath)))
+            for new_file in new_file_list:
+                new_file_rel = os.path.relpath(new_file, os.path.join(os.getcwd(), TEMP_FRPG_DIR))
+                manifest_string_list.append(" " + new_file_rel)
+    manifest_string_list.append("-- Custom --")
+    manifest_string_list.append(" " + os.path.relpath(custom_filepath, os.path.join(os.getcwd(), TEMP_FRPG_DIR)))
+    manifest_file = os.path.join(os.getcwd(), TEMP_FRPG_DIR, BND_MANIFEST_FILE)
+    output_dirs.prepare([manifest_file])
+    with open(manifest_file, 'w') as g:
         g.write(BND_MANIFEST_HEADER)
         g.write('\n'.join(manifest_string_list))
         g.close()
+    decompressor.close()
+    writer.close()
     
-    log.info("Build bdt/bhd pairing.")
-    print " - Examining unpacked files for BDT/BHD pairs...",
-    pairing_dict = build_bdt_bhd_pairing(list(set(created_file_list)))
-    for bdt_file in pairing_dict:
-        if len(pairing_dict[bdt_file]) == 0:
-            raise ValueError("BDT File \"" + str(bdt_file) + "\" has no corresponding header file.")
-    print "Done."
-    
-    total_pairs = len(pairing_dict.keys())
-    for count, bdt_file in enumerate(sorted(pairing_dict.keys())):
-        print "\r - (" + str(count+1) + "/" + str(total_pairs) + ") Unpacking BDT/BHD pairs... "
-        (_, bdt_filename) = os.path.split(os.path.abspath(bdt_file))
-        matching_bhd_file = pairing_dict[bdt_file][0]
-        (_, bhd_filename) = os.path.split(os.path.abspath(matching_bhd_file))
-        
-        print "  - Unpacking archive " + str(bdt_filename) + " using header " + str(bhd_filename)
-        log.info("Unpack " + str(bdt_filename) + " via " + str(bhd_filename))
-        
-        # Redirect the output of the file depending on its extension, so that
-        #  the .exe modifications make sense.
-        (_, bdt_file_ext) = os.path.splitext(bdt_filename)
-        if bdt_file_ext == ".chrtpfbdt":
-            rel_directory = "chr"
-        elif bdt_file_ext == ".hkxbdt":
-            rel_directory = "map"
-        elif bdt_file_ext == ".tpfbdt":
-            rel_directory = os.path.join("map", "tx")
-        else:
-            raise ValueError("Unrecognized *bdt file extension: \"" + bdt_file_ext + "\".")
-        directory = os.path.abspath(os.path.join(os.getcwd(), rel_directory))
-        bdt_unpacker.unpack_archive(matching_bhd_file, bdt_file, directory)
-        print "\r" + (ANSI_CURSOR_UP_LINE + ANSI_CLEAR_LINE)*4, # Erase the previous three lines.
-    print "\r - (" + str(total_pairs) + "/" + str(total_pairs) + ") Unpacking BDT/BHD pairs... Done."
-     
-    print " - Removing BDT/BHD pairs... ",
-    log.info("Remove bdt/bhd pairs.")
-    for bdt_file in pairing_dict.keys(): 
-        matching_bhd_file = pairing_dict[bdt_file][0]
-        try:
-            os.remove(bdt_file)
-        except OSError:
-            if not os.path.isfile(bdt_file):
-                raise
-        try:
-            os.remove(matching_bhd_file)
-        except OSError:
-            if not os.path.isfile(matching_bhd_file):
-                raise
-    print "Done."
+    log.info("Peak file content in memory: " + str(budget.peak) + " bytes.")
+    print " - Peak file content held in memory: %.1f MB" % (budget.peak / 1048576.0) + \
+     (" (limit %.1f MB)." % (memory_limit / 1048576.0) if memory_limit is not None else ".")
     return
     
 def remove_archives():
@@ -580,7 +705,8 @@ def attempt_unpack():
     log.info("Unpacking dvdbnds.")
     print "Unpacking archives..."
     create_unpacked_dirs()
-    unpack_archives()
+    # Nothing needs the unpacked *bnd files if they will be removed anyway.
+    unpack_archives(keep_bnd_tree=not should_remove_temp_dir)
     print "Done."
 
     log.info("Removing dvdbnds.")